@@ -3,12 +3,17 @@
 """Automatically generate masks for a phantom in a scan."""
 
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+import os
 
 import nibabel as nib
 import numpy as np
+import scipy.ndimage as ndi
 import skimage.filters as filters
 import skimage.morphology as mm
 
+from dmriphantomutils import image_io
+
 def mask_phantom(slice_b0):
     """Generate a mask for the phantom material in a slice.
 
@@ -33,7 +38,222 @@ def mask_phantom(slice_b0):
     slice_phantom_mask = slice_b0 > slice_b0_threshold
     return mm.binary_erosion(slice_phantom_mask, mm.disk(3))
 
-def main(nifti_path, slice_idx, mask_output):
+def threshold_otsu_stack(slices_b0, nbins=256):
+    """Compute Otsu's threshold for each slice in a stack at once.
+
+    The histograms of every slice are built in one pass, each with
+    ``nbins`` bins spanning that slice's range (or, for integer data,
+    one bin per integer value, as skimage does), and the thresholds are
+    found with the same between-class variance criterion as
+    ``skimage.filters.threshold_otsu``, applied to all slices together.
+
+    Parameters
+    ----------
+    slices_b0 : array_like
+        3D array of image data, where each z-slice is thresholded
+        separately.
+    nbins : int, optional
+        Number of histogram bins per slice. Ignored for integer data.
+
+    Returns
+    -------
+    array_like
+        1D array with the threshold for each slice.
+    """
+
+    slices_b0 = np.asarray(slices_b0)
+    n_slices = slices_b0.shape[2]
+    flat = slices_b0.reshape(-1, n_slices)
+
+    lower = flat.min(axis=0)
+    upper = flat.max(axis=0)
+    constant = lower == upper
+
+    if np.issubdtype(flat.dtype, np.integer):
+        # Like threshold_otsu, integer images get one bin per value,
+        # starting from each slice's minimum
+        lower = lower.astype(np.int64)
+        nbins = int((upper.astype(np.int64) - lower).max()) + 1
+        bin_idx = flat.astype(np.int64) - lower
+        bin_centers = lower[:, np.newaxis] + np.arange(nbins)
+    else:
+        flat = flat.astype(float)
+        span = (upper - lower).astype(float)
+        span[constant] = 1
+
+        bin_idx = np.floor((flat - lower) / span * nbins).astype(np.intp)
+        np.clip(bin_idx, 0, nbins - 1, out=bin_idx)
+
+        edges = lower[:, np.newaxis] + (
+            span[:, np.newaxis] * np.linspace(0, 1, nbins + 1))
+        bin_centers = (edges[:, :-1] + edges[:, 1:]) / 2
+
+    bin_idx += np.arange(n_slices) * nbins
+    counts = np.bincount(
+        bin_idx.ravel(), minlength=n_slices * nbins).reshape(n_slices, nbins)
+
+    # class probabilities and means for all possible thresholds
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weight1 = np.cumsum(counts, axis=1)
+        weight2 = np.cumsum(counts[:, ::-1], axis=1)[:, ::-1]
+        mean1 = np.cumsum(counts * bin_centers, axis=1) / weight1
+        mean2 = (np.cumsum((counts * bin_centers)[:, ::-1], axis=1)
+                 / weight2[:, ::-1])[:, ::-1]
+        variance12 = (weight1[:, :-1] * weight2[:, 1:]
+                      * (mean1[:, :-1] - mean2[:, 1:]) ** 2)
+
+    variance12 = np.nan_to_num(variance12, nan=-np.inf)
+    thresholds = bin_centers[
+        np.arange(n_slices), np.argmax(variance12, axis=1)]
+
+    # Like threshold_otsu, constant slices are thresholded at their value
+    return np.where(constant, lower, thresholds)
+
+def mask_phantom_stack(slices_b0):
+    """Generate masks for the phantoms in a stack of slices at once.
+
+    This is the batched counterpart to ``mask_phantom``: each slice is
+    thresholded with its own Otsu threshold (see
+    ``threshold_otsu_stack``), and the erosion is done as a single 3D
+    operation with a 2D footprint.
+
+    Parameters
+    ----------
+    slices_b0 : array_like
+        3D array of image data, where each z-slice contains a single
+        phantom.
+
+    Returns
+    -------
+    array_like
+        3D boolean array, where True values indicate phantom voxels.
+    """
+
+    thresholds = threshold_otsu_stack(slices_b0)
+    phantom_masks = np.asarray(slices_b0) > thresholds
+
+    return ndi.binary_erosion(
+        phantom_masks, structure=mm.disk(3)[:, :, np.newaxis],
+        border_value=1)
+
+def mask_phantoms(img_b0, slice_idxs=None, workers=1):
+    """Mask the phantom in each of a set of z-slices.
+
+    Parameters
+    ----------
+    img_b0 : array_like
+        3D array of b0 image data, with one phantom per z-slice.
+    slice_idxs : iterable of int, optional
+        Indices of the slices to be masked. Defaults to every slice.
+    workers : int, optional
+        The number of processes to mask slices with, or None to use
+        every CPU. With one worker, every slice is masked in a single
+        batched pass; otherwise each worker masks a chunk of slices.
+
+    Returns
+    -------
+    array_like
+        3D labeled mask, where the phantom in z-slice i is labeled i + 1,
+        and unmasked voxels are 0.
+    """
+
+    if slice_idxs is None:
+        slice_idxs = range(img_b0.shape[2])
+    slice_idxs = np.array(list(slice_idxs), dtype=np.intp)
+
+    if workers == 1:
+        slice_masks = mask_phantom_stack(img_b0[:, :, slice_idxs])
+    else:
+        chunks = [img_b0[:, :, chunk_idxs] for chunk_idxs in
+                  np.array_split(slice_idxs, workers or os.cpu_count() or 1)
+                  if len(chunk_idxs) > 0]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            slice_masks = np.concatenate(
+                list(executor.map(mask_phantom_stack, chunks)), axis=2)
+
+    labels = np.zeros(img_b0.shape,
+                      dtype=np.min_scalar_type(img_b0.shape[2]))
+    labels[:, :, slice_idxs] = slice_masks * (slice_idxs + 1)
+
+    return labels
+
+def estimate_b0(dwi, b0_threshold=None, statistic='mean'):
+    """Estimate a b0 image from every b0 volume of a DWI.
+
+    Only the b0 volumes are read, so a lazily loaded DWI never has its
+    diffusion-weighted volumes pulled into memory.
+
+    Parameters
+    ----------
+    dwi : DiffusionWeightedImage
+        The DWI from which to estimate the b0 image.
+    b0_threshold : float, optional
+        The b-value up to which (inclusive) a volume is considered a b0,
+        as for DIPY's ``b0s_mask``. Defaults to the gradient table's
+        threshold.
+    statistic : {'mean', 'median'}, optional
+        How the b0 volumes are combined. The median is more robust to
+        outlying volumes.
+
+    Returns
+    -------
+    array_like
+        3D array of the estimated b0 image.
+    """
+
+    if b0_threshold is None:
+        b0_threshold = dwi.gtab.b0_threshold
+
+    # Like DIPY's b0s_mask, the threshold itself counts as a b0
+    b0_idx = dwi.gtab.bvals <= b0_threshold
+
+    if not b0_idx.any():
+        raise ValueError(
+            'No volumes have a b-value up to {}.'.format(b0_threshold))
+
+    b0_volumes = dwi.get_volumes(b0_idx)
+
+    if statistic == 'mean':
+        return b0_volumes.mean(axis=3)
+    elif statistic == 'median':
+        return np.median(b0_volumes, axis=3)
+    else:
+        raise ValueError('Unknown b0 statistic: {}'.format(statistic))
+
+def load_b0(nifti_path, bval_path=None, bvec_path=None, b0_threshold=250,
+        statistic='mean'):
+    """Load the b0 image of a DWI, reading as few volumes as possible.
+
+    Parameters
+    ----------
+    nifti_path : str
+        Path to the nifti DWI.
+    bval_path, bvec_path : str, optional
+        Paths to the .bval and .bvec files. If given, the b0 is estimated
+        from every b0 volume; otherwise, the first volume is used.
+    b0_threshold : float, optional
+        The b-value up to which (inclusive) a volume is considered a b0.
+    statistic : {'mean', 'median'}, optional
+        How the b0 volumes are combined.
+
+    Returns
+    -------
+    img : SpatialImage
+        The NiBabel image of the DWI.
+    img_b0 : array_like
+        3D array of the b0 image.
+    """
+
+    if bval_path is None or bvec_path is None:
+        img = nib.load(nifti_path)
+        return img, np.asanyarray(img.dataobj[..., 0])
+
+    dwi = image_io.load_dwi(nifti_path, bval_path, bvec_path,
+                            b0_threshold=b0_threshold, lazy=True)
+    return dwi.img, estimate_b0(dwi, b0_threshold, statistic)
+
+def main(nifti_path, slice_idx, mask_output, bval_path=None, bvec_path=None,
+         b0_threshold=250, b0_statistic='mean'):
     """Load an image and mask one z-slice.
 
     Parameters
@@ -44,28 +264,84 @@ def main(nifti_path, slice_idx, mask_output):
         Index of the slice to be masked.
     mask_output : str
         Path to which the mask image should be saved.
+    bval_path, bvec_path : str, optional
+        Paths to the .bval and .bvec files, to estimate the b0 from every
+        b0 volume instead of the first volume.
+    b0_threshold : float, optional
+        The b-value up to which (inclusive) a volume is considered a b0.
+    b0_statistic : {'mean', 'median'}, optional
+        How the b0 volumes are combined.
     """
-    img = nib.load(nifti_path)
-    img_data = img.get_data()
-    img_b0 = img_data[:, :, :, 0]
+    img, img_b0 = load_b0(nifti_path, bval_path, bvec_path, b0_threshold,
+                          b0_statistic)
 
     slice_b0 = img_b0[:, :, slice_idx]
     slice_phantom_mask = mask_phantom(slice_b0)
 
-    out_data = np.zeros(img_b0.shape)
+    out_data = np.zeros(img_b0.shape, dtype=np.uint8)
     out_data[:, :, slice_idx] = slice_phantom_mask
 
     mask_img = nib.nifti1.Nifti1Image(out_data, img.affine, header=img.header)
+    mask_img.set_data_dtype(np.uint8)
     nib.save(mask_img, mask_output)
 
+def main_labeled(nifti_path, mask_output, slice_range=None, workers=1,
+        bval_path=None, bvec_path=None, b0_threshold=250,
+        b0_statistic='mean'):
+    """Load an image and mask every z-slice into one labeled mask.
+
+    Parameters
+    ----------
+    nifti_path : str
+        Path to the image to be masked.
+    mask_output : str
+        Path to which the labeled mask should be saved, as a nifti or
+        .npz file (see ``image_io.save_mask``).
+    slice_range : tuple of int, optional
+        The first slice to be masked, and the slice after the last.
+        Defaults to every slice.
+    workers : int, optional
+        The number of processes to mask slices with, or None to use
+        every CPU.
+    bval_path, bvec_path : str, optional
+        Paths to the .bval and .bvec files, to estimate the b0 from every
+        b0 volume instead of the first volume.
+    b0_threshold : float, optional
+        The b-value up to which (inclusive) a volume is considered a b0.
+    b0_statistic : {'mean', 'median'}, optional
+        How the b0 volumes are combined.
+    """
+
+    img, img_b0 = load_b0(nifti_path, bval_path, bvec_path, b0_threshold,
+                          b0_statistic)
+
+    slice_idxs = None if slice_range is None else range(*slice_range)
+    labels = mask_phantoms(img_b0, slice_idxs, workers)
+
+    image_io.save_mask(labels, img.affine, mask_output)
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=
-            'Load a nifti image and mask the phantom from one slice.')
+            'Load a nifti image and mask the phantom from one slice, or '
+            + 'from every slice into a labeled mask if no slice is given.')
     parser.add_argument('nifti')
-    parser.add_argument('z_slice', type=int)
+    parser.add_argument('z_slice', type=int, nargs='?')
     parser.add_argument('output')
+    parser.add_argument('--range', type=int, nargs=2,
+                        metavar=('START', 'STOP'))
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--bval')
+    parser.add_argument('--bvec')
+    parser.add_argument('--b0-threshold', type=float, default=250)
+    parser.add_argument('--b0-statistic', choices=['mean', 'median'],
+                        default='mean')
 
     args = parser.parse_args()
 
-    main(args.nifti, args.z_slice, args.output)
-
+    if args.z_slice is None:
+        main_labeled(args.nifti, args.output, args.range, args.workers,
+                     args.bval, args.bvec, args.b0_threshold,
+                     args.b0_statistic)
+    else:
+        main(args.nifti, args.z_slice, args.output, args.bval, args.bvec,
+             args.b0_threshold, args.b0_statistic)
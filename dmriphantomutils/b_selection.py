@@ -1,6 +1,7 @@
 """Filter a set of gradients by direction and b-val."""
 
 import numpy as np
+from scipy.spatial import cKDTree
 
 def get_acquisitions_by_bval(bvals, lower, upper):
     """Get b-vals within a certain range.
@@ -41,6 +42,69 @@ def spherical_distance(theta1, phi1, theta2, phi2):
     return np.arccos((np.cos(theta1) * np.cos(theta2))
             + (np.sin(theta1) * np.sin(theta2) * np.cos(phi1 - phi2)))
 
+def get_unit_vectors(phi, theta):
+    """Get unit vectors pointing in given directions.
+
+    Parameters
+    ----------
+    phi : array_like
+        Azimuthal angles of the directions, in degrees.
+    theta : array_like
+        Polar angles of the directions, in degrees.
+
+    Returns
+    -------
+    array_like
+        Array of shape (..., 3) of the unit vectors.
+    """
+
+    phi = np.radians(phi)
+    theta = np.radians(theta)
+
+    return np.stack([np.sin(theta) * np.cos(phi),
+                     np.sin(theta) * np.sin(phi),
+                     np.cos(theta)], axis=-1)
+
+def get_acquisitions_by_dirs(bvecs, phi, theta, tolerance):
+    """Get b-vectors close to each of several directions.
+
+    Directions are compared with the absolute dot product of unit
+    vectors, so a b-vector close to a direction's antipode is also
+    included.
+
+    Parameters
+    ----------
+    bvecs : array_like
+        2D array of b-vectors to be filtered.
+    phi : array_like
+        1D array of azimuthal angles of the directions, in degrees.
+    theta : array_like
+        1D array of polar angles of the directions, in degrees.
+    tolerance : float or array_like
+        b-vecs with spherical distance less than this tolerance, in
+        degrees, will be included. Either one tolerance for every
+        direction, or one per direction.
+
+    Returns
+    -------
+    array_like
+        Logical array of shape (number of directions, number of b-vecs),
+        where each row indexes the b-vectors close to one direction.
+        b-vectors of length 0 are never included.
+    """
+
+    bvecs = np.asarray(bvecs, dtype=float)
+    bvec_r = np.linalg.norm(bvecs, axis=1)
+    unit_bvecs = np.divide(bvecs, bvec_r[:, np.newaxis],
+                           out=np.zeros_like(bvecs),
+                           where=bvec_r[:, np.newaxis] > 0)
+
+    targets = get_unit_vectors(np.atleast_1d(phi), np.atleast_1d(theta))
+    min_cos = np.cos(np.radians(np.atleast_1d(tolerance)))
+
+    cos_dist = np.abs(targets @ unit_bvecs.T)
+    return (cos_dist > min_cos[:, np.newaxis]) & (bvec_r > 0)
+
 def get_acquisitions_by_dir(bvecs, phi, theta, tolerance):
     """Get b-vectors close to a given direction.
 
@@ -62,25 +126,150 @@ def get_acquisitions_by_dir(bvecs, phi, theta, tolerance):
         Index array of the b-vectors to be included.
     """
 
-    phi = np.radians(phi)
-    theta = np.radians(theta)
-    tolerance = np.radians(tolerance)
+    return get_acquisitions_by_dirs(bvecs, phi, theta, tolerance)[0]
 
-    antipodal_theta = (-1 * (theta - (np.pi / 2))) + (np.pi / 2)
-    if phi > 0:
-        antipodal_phi = phi - np.pi
-    else:
-        antipodal_phi = phi + np.pi
+class GradientIndex:
+    """An index of a gradient table for repeated acquisition selection.
 
-    bvec_phi = np.arctan2(bvecs[:, 1], bvecs[:, 0])
-    bvec_r = np.linalg.norm(bvecs, axis=1)
-    bvec_theta = np.arccos(bvecs[:, 2] / bvec_r)
+    The b-values are sorted once, so a range of b-values is found by
+    binary search, and the b-vectors are stored in a KD-tree on the unit
+    sphere, so only b-vectors near a queried direction are visited.
+
+    Parameters
+    ----------
+    gtab : GradientTable
+        The gradient table to index.
+    shell_tolerance : float, optional
+        b-values within this distance of their neighbours when sorted are
+        grouped into the same shell.
+
+    Attributes
+    ----------
+    shells : array_like
+        The mean b-value of each shell, in increasing order.
+    shell_idx : array_like
+        The index into ``shells`` of each acquisition's shell.
+    """
+
+    def __init__(self, gtab, shell_tolerance=50):
+        self.bvals = np.asarray(gtab.bvals, dtype=float)
+        self.bvecs = np.asarray(gtab.bvecs, dtype=float)
+
+        self._order = np.argsort(self.bvals, kind='stable')
+        self._sorted_bvals = self.bvals[self._order]
+
+        new_shell = np.diff(self._sorted_bvals) > shell_tolerance
+        sorted_shell_idx = np.concatenate(
+            [[0], np.cumsum(new_shell)]).astype(int)
+        self.shell_idx = np.empty(len(self.bvals), dtype=int)
+        self.shell_idx[self._order] = sorted_shell_idx
+        self.shells = (
+            np.bincount(sorted_shell_idx, weights=self._sorted_bvals)
+            / np.bincount(sorted_shell_idx))
+
+        bvec_r = np.linalg.norm(self.bvecs, axis=1)
+        self._dir_idx = np.flatnonzero(bvec_r > 0)
+        self._tree = cKDTree(
+            self.bvecs[self._dir_idx] / bvec_r[self._dir_idx, np.newaxis])
+
+    def _to_logical(self, idx):
+        selection = np.zeros(len(self.bvals), dtype=bool)
+        selection[idx] = True
+        return selection
+
+    def get_acquisitions_by_bval(self, lower, upper):
+        """Get b-vals within a certain range.
+
+        Parameters
+        ----------
+        lower : float
+            The minimum b-value to include.
+        upper : float
+            The maximum b-value to include.
+
+        Returns
+        -------
+        array_like
+            Logical index array for b-values to include.
+        """
+
+        start, stop = np.searchsorted(self._sorted_bvals, [lower, upper])
+        return self._to_logical(self._order[start:stop])
+
+    def get_acquisitions_by_shell(self, bval):
+        """Get the acquisitions in the shell nearest a b-value.
+
+        Parameters
+        ----------
+        bval : float
+            The approximate b-value of the shell.
+
+        Returns
+        -------
+        array_like
+            Logical index array for the acquisitions in the shell.
+        """
+
+        return self.shell_idx == np.argmin(np.abs(self.shells - bval))
+
+    def get_acquisitions_by_dirs(self, phi, theta, tolerance):
+        """Get b-vectors close to each of several directions.
+
+        Parameters
+        ----------
+        phi : array_like
+            1D array of azimuthal angles of the directions, in degrees.
+        theta : array_like
+            1D array of polar angles of the directions, in degrees.
+        tolerance : float or array_like
+            b-vecs with spherical distance less than this tolerance, in
+            degrees, will be included. Either one tolerance for every
+            direction, or one per direction.
+
+        Returns
+        -------
+        array_like
+            Logical array of shape (number of directions, number of
+            b-vecs), where each row indexes the b-vectors close to one
+            direction, or its antipode.
+        """
+
+        targets = get_unit_vectors(np.atleast_1d(phi), np.atleast_1d(theta))
+        tolerance = np.radians(np.broadcast_to(tolerance, len(targets)))
+        # Chord length between unit vectors separated by the tolerance
+        radii = 2 * np.sin(tolerance / 2)
+        min_cos = np.cos(tolerance)
+
+        selection = np.zeros((len(targets), len(self.bvals)), dtype=bool)
+        for points in [targets, -targets]:
+            for row, neighbours in enumerate(
+                    self._tree.query_ball_point(points, radii)):
+                # The tree includes the boundary, so apply the same strict
+                # test as get_acquisitions_by_dirs to its candidates
+                neighbours = np.asarray(neighbours, dtype=np.intp)
+                close = (np.abs(self._tree.data[neighbours] @ targets[row])
+                         > min_cos[row])
+                selection[row, self._dir_idx[neighbours[close]]] = True
+
+        return selection
 
-    target_dist = spherical_distance(theta, phi, bvec_theta, bvec_phi)
-    antipodal_dist = spherical_distance(antipodal_theta, antipodal_phi,
-            bvec_theta, bvec_phi)
+    def get_acquisitions_by_dir(self, phi, theta, tolerance):
+        """Get b-vectors close to a given direction.
 
-    dist = np.minimum(target_dist, antipodal_dist)
+        Parameters
+        ----------
+        phi : float
+            Azimuthal angle of the direction, in degrees.
+        theta : float
+            Polar angle of the direction, in degrees.
+        tolerance : float
+            b-vecs with spherical distance less than this tolerance, in
+            degrees, will be included.
 
-    return dist < tolerance
+        Returns
+        -------
+        array_like
+            Logical index array of the b-vectors to be included.
+        """
 
+        return self.get_acquisitions_by_dirs(phi, theta, tolerance)[0]
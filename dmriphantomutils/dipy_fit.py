@@ -3,16 +3,177 @@
 """Wrapper that uses DIPY to fit DTI and DKI representations."""
 
 import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import os
 import sys
+import warnings
 
 import dipy.reconst.dki as dki
 import dipy.reconst.dti as dti
 import numpy as np
 import scipy.ndimage as ndi
 
-from dmriphantomutils import image_io
+from dmriphantomutils import fit_cache, image_io
 
-def fit_dki(dwi, blur=False):
+DTI_METRICS = ('fa', 'md', 'ad', 'rd')
+DKI_METRICS = DTI_METRICS + ('mk', 'ak', 'rk')
+
+class MaskedFit:
+    """A model fit to only the masked voxels of an image.
+
+    Values of the underlying fit with one entry per masked voxel (e.g.
+    ``fa``, or the result of ``mk(min_kurtosis=0)``) are scattered back
+    into image space, with 0s outside the mask. Other values are passed
+    through unchanged.
+
+    Parameters
+    ----------
+    fit : TensorFit or DiffusionKurtosisFit
+        A fit to an (N, n_gradients) array of masked voxel data.
+    mask : array_like
+        A 3D boolean numpy array with N True voxels.
+    """
+
+    def __init__(self, fit, mask):
+        self.fit = fit
+        self.mask = mask
+        self.n_voxels = int(mask.sum())
+
+    def scatter(self, values):
+        """Place an array of per-voxel values into a full image.
+
+        Parameters
+        ----------
+        values : array_like
+            An array whose first dimension has one entry per masked voxel.
+
+        Returns
+        -------
+        array_like
+            An array with the mask's shape (plus any trailing dimensions
+            of values), with 0s outside the mask.
+        """
+
+        values = np.asarray(values)
+        image = np.zeros(self.mask.shape + values.shape[1:],
+                         dtype=values.dtype)
+        image[self.mask] = values
+        return image
+
+    def _scatter_voxelwise(self, value):
+        if (isinstance(value, np.ndarray) and value.ndim > 0
+                and value.shape[0] == self.n_voxels):
+            return self.scatter(value)
+        return value
+
+    def __getattr__(self, name):
+        if name in ('fit', 'mask', 'n_voxels'):
+            raise AttributeError(name)
+
+        attr = getattr(self.fit, name)
+        if callable(attr):
+            return lambda *args, **kwargs: self._scatter_voxelwise(
+                attr(*args, **kwargs))
+
+        return self._scatter_voxelwise(attr)
+
+def _get_blur_crop(mask, sigma=0.5):
+    """Get the region of a DWI needed to blur the masked voxels in-plane.
+
+    The Gaussian kernel never reaches more than a few voxels, so
+    blurring only the mask's bounding box plus the kernel radius gives
+    the masked voxels the same values as blurring the whole image.
+    """
+
+    radius = int(4.0 * sigma + 0.5)
+    coords = np.nonzero(mask)
+
+    return tuple(
+        slice(max(axis_coords.min() - pad, 0), axis_coords.max() + pad + 1)
+        for axis_coords, pad in zip(coords, (radius, radius, 0)))
+
+def get_voxel_data(dwi, blur=False):
+    """Extract the masked voxels of a DWI as a contiguous matrix.
+
+    Parameters
+    ----------
+    dwi : DiffusionWeightedImage
+        DWI data to extract, with a mask if applicable.
+    blur : bool, optional
+        True if the image should be blurred before extraction.
+
+    Returns
+    -------
+    voxel_data : array_like
+        An (N, n_gradients) array with one row per masked voxel.
+    mask : array_like
+        A 3D boolean array with the N masked voxels.
+    """
+
+    try:
+        mask = np.asanyarray(dwi.mask).astype(bool)
+    except AttributeError:
+        mask = np.ones(dwi.img.shape[:3], dtype=bool)
+
+    # Only read the z-slices spanned by the mask
+    z_idx = np.nonzero(mask.any(axis=(0, 1)))[0]
+    if len(z_idx) == 0:
+        return np.zeros((0, len(dwi.gtab.bvals))), mask
+
+    slab = dwi.get_slab(z_idx[0], z_idx[-1] + 1)
+    slab_mask = mask[:, :, z_idx[0]:z_idx[-1] + 1]
+
+    if blur:
+        crop = _get_blur_crop(slab_mask)
+        slab = ndi.gaussian_filter(slab[crop], [0.5, 0.5, 0, 0])
+        slab_mask = slab_mask[crop]
+
+    return np.ascontiguousarray(slab[slab_mask]), mask
+
+def _fit_dki_params(gtab, voxel_data):
+    """Fit a DKI model to a chunk of voxels and return its parameters."""
+
+    return dki.DiffusionKurtosisModel(gtab).fit(voxel_data).model_params
+
+def fit_dki_parallel(dkimodel, voxel_data, workers=None, chunks_per_worker=4):
+    """Fit a DKI model to a matrix of voxels in a process pool.
+
+    Parameters
+    ----------
+    dkimodel : DiffusionKurtosisModel
+        The model to fit.
+    voxel_data : array_like
+        An (N, n_gradients) array with one row per voxel.
+    workers : int, optional
+        The number of worker processes. Defaults to the number of CPUs.
+    chunks_per_worker : int, optional
+        The number of chunks of voxels to give to each worker.
+
+    Returns
+    -------
+    DiffusionKurtosisFit
+        The fit of all N voxels, as if they had been fit together.
+    """
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    chunks = [chunk for chunk in np.array_split(
+                  voxel_data, workers * chunks_per_worker)
+              if len(chunk) > 0]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        chunk_params = list(executor.map(
+            _fit_dki_params, [dkimodel.gtab] * len(chunks), chunks))
+
+    if chunk_params:
+        params = np.concatenate(chunk_params)
+    else:
+        params = np.zeros((0, 27))
+
+    return dki.DiffusionKurtosisFit(dkimodel, params)
+
+def fit_dki(dwi, blur=False, masked_only=False, workers=1):
     """Fit a DKI model to a DWI, applying a mask if provided.
 
     Parameters
@@ -21,15 +182,31 @@ def fit_dki(dwi, blur=False):
         DWI data to fit to the model.
     blur : bool, optional
         True if the image should be blurred before the model fit.
+    masked_only : bool, optional
+        True if only the masked voxels should be extracted and fit,
+        returning a MaskedFit.
+    workers : int, optional
+        The number of processes to fit with. If not 1, the masked voxels
+        are fit in chunks in a process pool (implying masked_only), and
+        None uses every CPU.
 
     Returns
     -------
-    dwifit : DiffusionKurtosisFit
+    dwifit : DiffusionKurtosisFit or MaskedFit
         A fit from which parameter maps can be generated
     """
 
     dkimodel = dki.DiffusionKurtosisModel(dwi.gtab)
 
+    if workers != 1:
+        voxel_data, mask = get_voxel_data(dwi, blur)
+        return MaskedFit(
+            fit_dki_parallel(dkimodel, voxel_data, workers), mask)
+
+    if masked_only:
+        voxel_data, mask = get_voxel_data(dwi, blur)
+        return MaskedFit(dkimodel.fit(voxel_data), mask)
+
     data = dwi.get_image()
     
     if blur:
@@ -42,24 +219,70 @@ def fit_dki(dwi, blur=False):
 
     return dkimodel.fit(data, mask)
 
-def fit_dti(dwi):
+def fit_dki_cached(dwi, cache, key, blur=False, masked_only=False,
+        workers=1):
+    """Fit a DKI model to a DWI, reusing cached parameters if possible.
+
+    Parameters
+    ---------
+    dwi : DiffusionWeightedImage
+        DWI data to fit to the model.
+    cache : FitCache
+        The cache in which the fit's parameters are stored.
+    key : str
+        The key identifying the fit's inputs, e.g. from
+        ``fit_cache.hash_inputs``.
+    blur, masked_only, workers : optional
+        Passed to ``fit_dki`` if the parameters are not cached.
+
+    Returns
+    -------
+    dwifit : DiffusionKurtosisFit or MaskedFit
+        A fit from which parameter maps can be generated
+    """
+
+    cached = cache.get(key)
+
+    if cached is not None:
+        dkifit = dki.DiffusionKurtosisFit(
+            dki.DiffusionKurtosisModel(dwi.gtab), cached['model_params'])
+        if 'mask' in cached:
+            return MaskedFit(dkifit, cached['mask'])
+        return dkifit
+
+    dkifit = fit_dki(dwi, blur, masked_only, workers)
+
+    if isinstance(dkifit, MaskedFit):
+        cache.put(key, model_params=dkifit.fit.model_params,
+                  mask=dkifit.mask)
+    else:
+        cache.put(key, model_params=dkifit.model_params)
+
+    return dkifit
+
+def fit_dti(dwi, masked_only=False):
     """Fit a DTI model to a DWI, applying a mask if provided.
 
     Parameters
     ---------
     dwi : DiffusionWeightedImage 
         DWI data to fit to the model.
-    blur : bool, optional
-        True if the image should be blurred before the model fit.
+    masked_only : bool, optional
+        True if only the masked voxels should be extracted and fit,
+        returning a MaskedFit.
 
     Returns
     -------
-    dwifit : TensorFit
+    dwifit : TensorFit or MaskedFit
         A fit from which parameter maps can be generated
     """
 
     dtimodel = dti.TensorModel(dwi.gtab)
 
+    if masked_only:
+        voxel_data, mask = get_voxel_data(dwi)
+        return MaskedFit(dtimodel.fit(voxel_data), mask)
+
     data = dwi.get_image()
 
     try:
@@ -69,6 +292,160 @@ def fit_dti(dwi):
 
     return dtimodel.fit(data, mask)
 
+def fit_dti_dki(dwi, blur=False, dti_bval_threshold=None, workers=1):
+    """Fit DTI and DKI models to the masked voxels of a DWI together.
+
+    The image is read, masked (and blurred) once, and both models are
+    fit to the same matrix of voxel data.
+
+    Parameters
+    ---------
+    dwi : DiffusionWeightedImage
+        DWI data to fit to the models.
+    blur : bool, optional
+        True if the image should be blurred before the model fits.
+    dti_bval_threshold : float, optional
+        If given, the DTI model is only fit to the acquisitions with
+        b-values up to this threshold, where the tensor model holds
+        best. Otherwise, it is fit to every acquisition, as by
+        ``fit_dti``.
+    workers : int, optional
+        The number of processes to fit the DKI model with, as for
+        ``fit_dki``.
+
+    Returns
+    -------
+    dtifit : MaskedFit
+        The DTI fit.
+    dkifit : MaskedFit
+        The DKI fit.
+    """
+
+    voxel_data, mask = get_voxel_data(dwi, blur)
+
+    dkimodel = dki.DiffusionKurtosisModel(dwi.gtab)
+    if workers != 1:
+        dkifit = fit_dki_parallel(dkimodel, voxel_data, workers)
+    else:
+        dkifit = dkimodel.fit(voxel_data)
+
+    if dti_bval_threshold is None:
+        dtimodel = dti.TensorModel(dwi.gtab)
+    else:
+        dti_idx = dwi.gtab.bvals <= dti_bval_threshold
+        dtimodel = dti.TensorModel(image_io.select_gtab(dwi.gtab, dti_idx))
+        voxel_data = voxel_data[:, dti_idx]
+
+    return (MaskedFit(dtimodel.fit(voxel_data), mask),
+            MaskedFit(dkifit, mask))
+
+def compute_metrics(fit, metrics=DKI_METRICS):
+    """Compute a set of metric images from a DTI or DKI fit.
+
+    The fit's parameters are flattened once, and only voxels that were
+    actually fit are processed. The eigenvalues are split out once, and
+    the mean diffusivity and its deviations are shared by MD, RD and FA.
+    The kurtosis metrics each run one of DIPY's compiled analytical
+    solutions on the shared parameter block; these take the raw
+    parameters and expose no intermediates, so nothing further is shared
+    between MK, AK and RK. Kurtosis metrics are clipped to [0, 10],
+    matching ``dkifit.mk(min_kurtosis=0)`` and friends.
+
+    Parameters
+    ----------
+    fit : TensorFit, DiffusionKurtosisFit or MaskedFit
+        The fit from which to compute the metrics. Kurtosis metrics
+        require a DKI fit.
+    metrics : collection of str, optional
+        The metrics to compute, from 'fa', 'md', 'ad', 'rd', 'mk', 'ak'
+        and 'rk'.
+
+    Returns
+    -------
+    dict
+        Maps each metric's name to its image.
+    """
+
+    if isinstance(fit, MaskedFit):
+        params = fit.fit.model_params
+        scatter = fit.scatter
+    else:
+        shape = fit.model_params.shape[:-1]
+        params = fit.model_params.reshape(-1, fit.model_params.shape[-1])
+
+        # Voxels outside the fit's mask have all-zero parameters
+        fitted = params.any(axis=1)
+        params = params[fitted]
+
+        def scatter(values):
+            image = np.zeros(fitted.shape)
+            image[fitted] = values
+            return image.reshape(shape)
+
+    params = np.ascontiguousarray(params, dtype=np.float64)
+    evals = params[:, :3]
+    diffusivities = {}
+
+    def mean_diffusivity():
+        if 'md' not in diffusivities:
+            diffusivities['md'] = evals.mean(axis=1)
+        return diffusivities['md']
+
+    def fractional_anisotropy():
+        # Equivalent to DIPY's pairwise form, with all-zero voxels set to 0
+        deviation = evals - mean_diffusivity()[:, None]
+        norm = (evals * evals).sum(axis=1)
+        return np.sqrt(1.5 * (deviation * deviation).sum(axis=1)
+                       / (norm + (norm == 0)))
+
+    metric_functions = {
+        'fa': fractional_anisotropy,
+        'md': mean_diffusivity,
+        'ad': lambda: evals[:, 0],
+        'rd': lambda: (3 * mean_diffusivity() - evals[:, 0]) / 2,
+        'mk': lambda: dki.mean_kurtosis(
+            params, min_kurtosis=0, max_kurtosis=10),
+        'ak': lambda: dki.axial_kurtosis(
+            params, min_kurtosis=0, max_kurtosis=10),
+        'rk': lambda: dki.radial_kurtosis(
+            params, min_kurtosis=0, max_kurtosis=10)}
+
+    return {metric: scatter(metric_functions[metric]())
+            for metric in metrics}
+
+def save_metric_imgs(metric_imgs, affine, metric_paths, workers=None,
+        dtype=None):
+    """Save a set of metric images concurrently.
+
+    Parameters
+    ----------
+    metric_imgs : dict
+        Maps each metric's name to its image.
+    affine
+        The affine transform to be used
+    metric_paths : dict
+        Maps each metric's name to the path to which it should be saved.
+    workers : int, optional
+        The number of threads to save with. Defaults to one per image.
+    dtype : data-type, optional
+        The data type to save the images with, e.g. np.float32.
+    """
+
+    if not metric_paths:
+        return
+
+    with ThreadPoolExecutor(
+            max_workers=workers or len(metric_paths)) as executor:
+        futures = [executor.submit(image_io.save_image, metric_imgs[metric],
+                                   affine, path, dtype)
+                   for metric, path in metric_paths.items()]
+        for future in futures:
+            future.result()
+
+def _get_metric_paths(**paths):
+    return {metric[:-len('_path')]: path
+            for metric, path in paths.items() if path is not None}
+
 def save_dti_metric_imgs(dwi, dtifit, fa_path=None, md_path=None, ad_path=None,
                          rd_path=None):
     """Save DTI metric images as NIFTI files.
@@ -83,19 +460,11 @@ def save_dti_metric_imgs(dwi, dtifit, fa_path=None, md_path=None, ad_path=None,
         The filepath to which each metric image should be saved.
     """
 
-    source_affine = dwi.img.affine
-
-    if fa_path is not None:
-        image_io.save_image(dtifit.fa, source_affine, fa_path)
-
-    if md_path is not None:
-        image_io.save_image(dtifit.md, source_affine, md_path)
-
-    if ad_path is not None:
-        image_io.save_image(dtifit.ad, source_affine, ad_path)
+    metric_paths = _get_metric_paths(
+        fa_path=fa_path, md_path=md_path, ad_path=ad_path, rd_path=rd_path)
 
-    if rd_path is not None:
-        image_io.save_image(dtifit.rd, source_affine, rd_path)
+    save_metric_imgs(compute_metrics(dtifit, metric_paths.keys()),
+                     dwi.img.affine, metric_paths)
 
 def save_dki_metric_imgs(
         dwi, dkifit, fa_path=None, md_path=None, ad_path=None,
@@ -114,33 +483,98 @@ def save_dki_metric_imgs(
         The filepaths to which each DKI metric image should be saved.
     """
 
-    source_affine = dwi.img.affine
-
     # Should think about theoretical min and max kurtosis values for us
-    if fa_path is not None:
-        image_io.save_image(dkifit.fa, source_affine, fa_path)
+    metric_paths = _get_metric_paths(
+        fa_path=fa_path, md_path=md_path, ad_path=ad_path, rd_path=rd_path,
+        mk_path=mk_path, ak_path=ak_path, rk_path=rk_path)
+
+    save_metric_imgs(compute_metrics(dkifit, metric_paths.keys()),
+                     dwi.img.affine, metric_paths)
+
+def save_metric_container(dwi, fit, output_path, metrics=DKI_METRICS):
+    """Save a set of metric images to one multi-volume nifti file.
+
+    Parameters
+    ----------
+    dwi : DiffusionWeightedImage
+        The source image from which the metrics are derived.
+    fit : TensorFit, DiffusionKurtosisFit or MaskedFit
+        The fit from which to compute the metrics.
+    output_path : str
+        The filepath to which the metric images should be saved. The
+        metrics can be loaded with ``image_io.load_multi_image``.
+    metrics : collection of str, optional
+        The metrics to save, from 'fa', 'md', 'ad', 'rd', 'mk', 'ak'
+        and 'rk'.
+    """
+
+    image_io.save_multi_image(
+        compute_metrics(fit, metrics), dwi.img.affine, output_path)
+
+def stream_dki_metric_imgs(
+        dwi, blur=False, fa_path=None, md_path=None, ad_path=None,
+        rd_path=None, mk_path=None, ak_path=None, rk_path=None):
+    """Fit a DKI model one z-slice at a time and save its metric images.
+
+    Each z-slice is read from disk, fit, and reduced to its metrics
+    before the next one is read, so only one slice of the 4D DWI is in
+    memory at a time. This suits scans with one phantom per z-slice,
+    especially when the DWI is loaded lazily. Since the blur is
+    in-plane, blurring each slice separately gives the same result as
+    blurring the whole image.
+
+    Parameters
+    ----------
+    dwi : DiffusionWeightedImage
+        DWI data to fit to the model, with a mask if applicable.
+    blur : bool, optional
+        True if the image should be blurred before the model fit.
+    fa_path, md_path, ad_path, rd_path : str, optional
+        The filepaths to which each DTI metric image should be saved.
+    mk_path, ak_path, rk_path : str, optional
+        The filepaths to which each DKI metric image should be saved.
+    """
+
+    metric_paths = _get_metric_paths(
+        fa_path=fa_path, md_path=md_path, ad_path=ad_path, rd_path=rd_path,
+        mk_path=mk_path, ak_path=ak_path, rk_path=rk_path)
 
-    if md_path is not None:
-        image_io.save_image(dkifit.md, source_affine, md_path)
+    dkimodel = dki.DiffusionKurtosisModel(dwi.gtab)
+    shape = dwi.img.shape[:3]
+    metric_imgs = {metric: np.zeros(shape) for metric in metric_paths}
+
+    try:
+        mask = np.asanyarray(dwi.mask).astype(bool)
+    except AttributeError:
+        mask = np.ones(shape, dtype=bool)
 
-    if ad_path is not None:
-        image_io.save_image(dkifit.ad, source_affine, ad_path)
+    for z_slice in range(shape[2]):
+        slice_mask = mask[:, :, z_slice]
+        if not slice_mask.any():
+            continue
 
-    if rd_path is not None:
-        image_io.save_image(dkifit.rd, source_affine, rd_path)
+        slice_data = dwi.get_slab(z_slice, z_slice + 1)[:, :, 0]
 
-    if mk_path is not None:
-        image_io.save_image(dkifit.mk(min_kurtosis=0), source_affine, mk_path)
+        if blur:
+            crop = _get_blur_crop(slice_mask)
+            slice_data = ndi.gaussian_filter(
+                slice_data[crop], [0.5, 0.5, 0])
+            slice_mask = slice_mask[crop]
+        else:
+            crop = (slice(None), slice(None))
 
-    if ak_path is not None:
-        image_io.save_image(dkifit.ak(min_kurtosis=0), source_affine, ak_path)
+        dkifit = MaskedFit(dkimodel.fit(slice_data[slice_mask]), slice_mask)
 
-    if rk_path is not None:
-        image_io.save_image(dkifit.rk(min_kurtosis=0), source_affine, rk_path)
+        for metric, values in compute_metrics(
+                dkifit, metric_paths.keys()).items():
+            metric_imgs[metric][:, :, z_slice][crop] = values
+
+    save_metric_imgs(metric_imgs, dwi.img.affine, metric_paths)
 
 def main(nifti_path, bval_path, bvec_path, mask_path=None, blur=False,
          fa_path=None, md_path=None, ad_path=None, rd_path=None, mk_path=None,
-         ak_path=None, rk_path=None):
+         ak_path=None, rk_path=None, workers=1, cache_dir=None,
+         cache_bytes=2 ** 30, stream=False, container_path=None):
     """Load and fit an image to a DKI model, then save its parameters.
 
     This is meant to deal with the functionality of this module being called as
@@ -170,16 +604,66 @@ def main(nifti_path, bval_path, bvec_path, mask_path=None, blur=False,
         Path to which the axial kurtosis image should be saved
     rk_path : str, optional
         Path to which the radial kurtosis image should be saved
+    workers : int, optional
+        Number of processes to fit with, or None to use every CPU
+    cache_dir : str, optional
+        Directory in which fitted parameters should be cached
+    cache_bytes : int, optional
+        Maximum size of the cache, in bytes
+    stream : bool, optional
+        True if the image should be read and fit one z-slice at a time.
+        Compressed images are decompressed once up front instead, since
+        every read of one decompresses it from the start. Streaming
+        can't be combined with workers, cache_dir or container_path.
+    container_path : str, optional
+        Path to which every DTI and DKI metric should be saved, as one
+        multi-volume image
     """
 
-    dwi = image_io.load_dwi(nifti_path, bval_path, bvec_path, mask_path)
+    if stream:
+        unsupported = [name for name, unset in [
+                           ('workers', workers == 1),
+                           ('cache_dir', cache_dir is None),
+                           ('container_path', container_path is None)]
+                       if not unset]
+        if unsupported:
+            raise ValueError('Streaming does not support: {}'.format(
+                ', '.join(unsupported)))
+
+        compressed = nifti_path.endswith(image_io.COMPRESSED_SUFFIXES)
+        if compressed:
+            warnings.warn('{} is compressed, so it is loaded whole instead '
+                          'of one z-slice at a time.'.format(nifti_path))
+        dwi = image_io.load_dwi(
+            nifti_path, bval_path, bvec_path, mask_path,
+            lazy=not compressed)
+        stream_dki_metric_imgs(
+            dwi, blur, fa_path=fa_path, md_path=md_path, ad_path=ad_path,
+            rd_path=rd_path, mk_path=mk_path, ak_path=ak_path,
+            rk_path=rk_path)
+        return
 
-    dkifit = fit_dki(dwi, blur)
+    dwi = image_io.load_dwi(nifti_path, bval_path, bvec_path, mask_path)
+    masked_only = mask_path is not None
+
+    if cache_dir is None:
+        dkifit = fit_dki(dwi, blur, masked_only=masked_only,
+                         workers=workers)
+    else:
+        cache = fit_cache.FitCache(cache_dir, max_bytes=cache_bytes)
+        key = fit_cache.hash_inputs(
+            [nifti_path, bval_path, bvec_path, mask_path], model='dki',
+            blur=blur, masked_only=masked_only)
+        dkifit = fit_dki_cached(dwi, cache, key, blur,
+                                masked_only=masked_only, workers=workers)
 
     save_dki_metric_imgs(dwi, dkifit, fa_path=fa_path, md_path=md_path,
                      ad_path=ad_path, rd_path=rd_path, mk_path=mk_path,
                      ak_path=ak_path, rk_path=rk_path)
 
+    if container_path is not None:
+        save_metric_container(dwi, dkifit, container_path)
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=
             'Load a nifti image and fit the data to a DKI model.')
@@ -195,8 +679,16 @@ if __name__ == "__main__":
     parser.add_argument('--mk')
     parser.add_argument('--ak')
     parser.add_argument('--rk')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--cache-dir')
+    parser.add_argument('--cache-bytes', type=int, default=2 ** 30)
+    parser.add_argument('--stream', action='store_true')
+    parser.add_argument('--container')
     args = parser.parse_args()
     main(args.nifti, args.bval, args.bvec, args.mask, blur=args.blur,
          fa_path=args.fa, md_path=args.md, ad_path=args.ad, rd_path=args.rd,
-         mk_path=args.mk, ak_path=args.ak, rk_path=args.rk)
+         mk_path=args.mk, ak_path=args.ak, rk_path=args.rk,
+         workers=args.workers, cache_dir=args.cache_dir,
+         cache_bytes=args.cache_bytes, stream=args.stream,
+         container_path=args.container)
 
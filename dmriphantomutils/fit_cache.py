@@ -0,0 +1,138 @@
+"""Cache fitted model parameters on disk.
+
+Fitting a DKI model is by far the slowest step in analyzing a phantom
+scan, and it is often repeated with exactly the same inputs. This module
+stores fitted parameter arrays under a key derived from the contents of
+the input files, so a fit only needs to be done once for a given set of
+inputs.
+
+The cache is capped in size. When it grows past the cap, the least
+recently used entries are evicted.
+"""
+
+import hashlib
+import os
+import tempfile
+import zipfile
+
+import numpy as np
+
+def hash_inputs(paths, **options):
+    """Generate a cache key from the contents of some files.
+
+    Parameters
+    ----------
+    paths : collection of str
+        Paths to the input files. None entries (e.g. a missing mask) are
+        allowed, and are hashed as absent files.
+    **options
+        Any other parameters that affect the fit, e.g. ``blur=True``.
+
+    Returns
+    -------
+    str
+        A hex digest identifying the inputs.
+    """
+
+    digest = hashlib.sha256()
+
+    for path in paths:
+        if path is None:
+            digest.update(b'\0none\0')
+            continue
+
+        with open(path, 'rb') as input_file:
+            for block in iter(lambda: input_file.read(1 << 20), b''):
+                digest.update(block)
+        digest.update(b'\0file\0')
+
+    for name, value in sorted(options.items()):
+        digest.update('{}={!r}\0'.format(name, value).encode())
+
+    return digest.hexdigest()
+
+class FitCache:
+    """A size-capped, least recently used cache of parameter arrays.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory in which the cached arrays are stored.
+    max_bytes : int, optional
+        Total size, in bytes, past which old entries are evicted.
+    """
+
+    def __init__(self, cache_dir, max_bytes=2 ** 30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _get_path(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def get(self, key):
+        """Load the arrays stored under a key.
+
+        Parameters
+        ----------
+        key : str
+            The key of the entry, e.g. from ``hash_inputs``.
+
+        Returns
+        -------
+        dict or None
+            The stored arrays by name, or None if the key is not cached.
+        """
+
+        path = self._get_path(key)
+
+        try:
+            with np.load(path) as entry:
+                arrays = {name: entry[name] for name in entry.files}
+        except FileNotFoundError:
+            return None
+        except (zipfile.BadZipFile, ValueError, OSError):
+            # A corrupt entry is treated as a miss, and refit
+            return None
+
+        # Mark the entry as recently used
+        os.utime(path)
+        return arrays
+
+    def put(self, key, **arrays):
+        """Store arrays under a key, then evict old entries if needed.
+
+        Parameters
+        ----------
+        key : str
+            The key of the entry, e.g. from ``hash_inputs``.
+        **arrays
+            The arrays to store, by name.
+        """
+
+        # Write to a temporary file first so readers never see a partial
+        # entry. Its suffix keeps evict from counting or removing it.
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+        with os.fdopen(fd, 'wb') as tmp_file:
+            np.savez(tmp_file, **arrays)
+        os.replace(tmp_path, self._get_path(key))
+
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until under the size cap."""
+
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.npz'):
+                continue
+            stat = os.stat(os.path.join(self.cache_dir, name))
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+        total_bytes = sum(size for _, size, _ in entries)
+
+        for _, size, name in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.cache_dir, name))
+            total_bytes -= size
@@ -6,13 +6,131 @@ information about the diffusion gradients. A derived image should be
 (usually) 3D data from analysis of a DWI.
 
 Either of the two may have a mask associated with them.
+
+Images can be loaded lazily, in which case their data is never cached
+in memory. Reads then go through NiBabel's array proxy (memory mapped
+for uncompressed files), and only the requested slices or volumes are
+read from disk. Every read of a compressed (.nii.gz) file decompresses
+it from the start, though, so lazy loading only pays off for
+uncompressed files.
 """
 
+from concurrent.futures import ThreadPoolExecutor
+import json
+import zlib
+
 from dipy.io import read_bvals_bvecs
 from dipy.core.gradients import gradient_table
 import nibabel as nib
 import numpy as np
 
+def select_gtab(gtab, selection):
+    """A gradient table containing only some of a table's acquisitions.
+
+    Parameters
+    ----------
+    gtab : GradientTable
+        The full gradient table.
+    selection : array_like
+        Integer or logical index array of the acquisitions to include.
+
+    Returns
+    -------
+    GradientTable
+        The selected acquisitions' gradient table.
+    """
+
+    return gradient_table(
+        gtab.bvals[selection], bvecs=gtab.bvecs[selection],
+        big_delta=gtab.big_delta, small_delta=gtab.small_delta,
+        b0_threshold=gtab.b0_threshold)
+
+COMPRESSED_SUFFIXES = ('.gz', '.bz2', '.zst')
+
+def _is_compressed(dataobj):
+    """Check whether an array proxy reads from a compressed file."""
+
+    while isinstance(dataobj, _VolumeSubset):
+        dataobj = dataobj.dataobj
+
+    file_like = getattr(dataobj, 'file_like', None)
+    return isinstance(file_like, str) and file_like.endswith(
+        COMPRESSED_SUFFIXES)
+
+def _indexed_shape(shape, key):
+    """Get the shape of an array indexed by integers and slices."""
+
+    return tuple(len(range(*axis_key.indices(length)))
+                 for axis_key, length in zip(key, shape)
+                 if isinstance(axis_key, slice))
+
+def _read_volumes(dataobj, spatial_key, vol_idx):
+    """Read some volumes of a 4D array or array proxy.
+
+    Every read of a compressed file decompresses it from the start, so
+    the range of volumes spanned by the selection is read at once and
+    then subselected. Otherwise, each run of consecutive volumes is read
+    separately, so only the selected volumes are read.
+    """
+
+    if len(vol_idx) == 0:
+        return np.zeros(_indexed_shape(dataobj.shape[:3], spatial_key)
+                        + (0,), dtype=dataobj.dtype)
+
+    if isinstance(dataobj, np.ndarray):
+        return dataobj[spatial_key][..., vol_idx]
+
+    if _is_compressed(dataobj):
+        start = int(vol_idx.min())
+        block = np.asanyarray(
+            dataobj[spatial_key + (slice(start, int(vol_idx.max()) + 1),)])
+        return block[..., vol_idx - start]
+
+    run_starts = np.flatnonzero(np.diff(vol_idx, prepend=-2) != 1)
+    run_stops = np.append(run_starts[1:], len(vol_idx))
+    return np.concatenate(
+        [np.asanyarray(dataobj[spatial_key + (
+             slice(int(vol_idx[start]), int(vol_idx[stop - 1]) + 1),)])
+         for start, stop in zip(run_starts, run_stops)], axis=-1)
+
+class _VolumeSubset:
+    """Array proxy reading only some volumes of a 4D array or proxy.
+
+    Given a single volume index instead of an array of them, the proxy
+    is 3D, holding just that volume. Supports basic indexing (integers,
+    slices and ``...``), which is all NiBabel and this module need.
+    """
+
+    is_proxy = True
+
+    def __init__(self, dataobj, vol_idx):
+        self.dataobj = dataobj
+        self.vol_idx = np.asarray(vol_idx)
+        self.shape = tuple(dataobj.shape[:3]) + self.vol_idx.shape
+        self.dtype = dataobj.dtype
+        self.ndim = len(self.shape)
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[...]
+        return data if dtype is None else data.astype(dtype)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if Ellipsis in key:
+            split = key.index(Ellipsis)
+            key = (key[:split] + (slice(None),) * (self.ndim + 1 - len(key))
+                   + key[split + 1:])
+        key = key + (slice(None),) * (self.ndim - len(key))
+
+        spatial_key = key[:3]
+        vol_idx = self.vol_idx[key[3:]]
+
+        if vol_idx.ndim == 0:
+            return np.asanyarray(self.dataobj[spatial_key + (int(vol_idx),)])
+
+        return _read_volumes(self.dataobj, spatial_key, vol_idx)
+
 class DiffusionWeightedImage:
     """Wrapper class including image and gradient data.
 
@@ -22,23 +140,100 @@ class DiffusionWeightedImage:
         The NiBabel image of the DWI
     gtab : GradientTable
         The DIPY gradient table associated with the scan
+    lazy : bool, optional
+        True if the image data should be read from disk on every access
+        instead of being cached. Otherwise, the whole image is read and
+        cached on the first access.
     """
 
-    def __init__(self, img, gtab):
+    def __init__(self, img, gtab, lazy=False):
         self.img = img
         self.gtab = gtab
+        self.lazy = lazy
+        self.data = None
 
     def get_image(self):
-        """A 3D numpy array with the image data."""
-        return self.img.get_data()
+        """A 4D numpy array with the image data."""
+
+        if self.data is not None:
+            return self.data
+
+        data = np.asanyarray(self.img.dataobj)
+        if not self.lazy:
+            self.data = data
+        return data
 
     def get_flat_data(self):
         """A 1D numpy array with the image data."""
-        return self.img.get_data().flatten()
+
+        return self.get_image().flatten()
+
+    def get_slab(self, start, stop):
+        """A 4D numpy array with the image data from a range of z-slices.
+
+        Parameters
+        ----------
+        start, stop : int
+            The first z-slice to include, and the z-slice after the last.
+        """
+
+        if self.data is not None or not self.lazy:
+            return self.get_image()[:, :, start:stop]
+
+        return np.asanyarray(self.img.dataobj[:, :, start:stop])
+
+    def get_volumes(self, vol_idx):
+        """A 4D numpy array with the image data from some acquisitions.
+
+        Parameters
+        ----------
+        vol_idx : array_like
+            Integer or logical index array of the volumes to include.
+        """
+
+        vol_idx = np.arange(self.img.shape[3])[vol_idx]
+
+        if self.data is not None or not self.lazy:
+            return self.get_image()[..., vol_idx]
+
+        return _read_volumes(self.img.dataobj, (slice(None),) * 3, vol_idx)
+
+    def _select_img_gtab(self, selection):
+        vol_idx = np.arange(self.img.shape[3])[selection]
+        # Read from the cached data if there is any, otherwise from disk
+        source = self.data if self.data is not None else self.img.dataobj
+
+        img = nib.Nifti1Image(_VolumeSubset(source, vol_idx),
+                              self.img.affine, self.img.header)
+        return img, select_gtab(self.gtab, vol_idx)
+
+    def select_acquisitions(self, selection):
+        """A DWI containing only some of this image's acquisitions.
+
+        Nothing is read until the new image's data is accessed, and then
+        only the selected volumes are read.
+
+        Parameters
+        ----------
+        selection : array_like
+            Integer or logical index array of the acquisitions to
+            include, e.g. from ``b_selection``.
+
+        Returns
+        -------
+        DiffusionWeightedImage
+            The selected acquisitions, with the matching gradient table.
+        """
+
+        img, gtab = self._select_img_gtab(selection)
+        return DiffusionWeightedImage(img, gtab, self.lazy)
 
 class MaskedDiffusionWeightedImage(DiffusionWeightedImage):
     """Wrapper class including an image, mask, and gradient data.
 
+    Only the 3D mask and the indices of its voxels are kept; the mask is
+    never repeated across the image's volumes.
+
     Parameters
     ----------
     img : SpatialImage
@@ -47,31 +242,165 @@ class MaskedDiffusionWeightedImage(DiffusionWeightedImage):
         The DIPY gradient table associated with the scan
     mask : array_like
         A binary numpy array, where 1s indicate voxels to be included.
+    data : array_like, optional
+        The already loaded image data, if it is shared with other images.
+    lazy : bool, optional
+        True if the image data should be read from disk on every access
+        instead of being cached.
     """
 
-    def __init__(self, img, gtab, mask):
-        DiffusionWeightedImage.__init__(self, img, gtab)
+    def __init__(self, img, gtab, mask, data=None, lazy=False):
+        DiffusionWeightedImage.__init__(self, img, gtab, lazy)
 
-        img_data = self.img.get_data()
-        if len(mask.shape) >= len(img_data.shape):
+        mask = np.asanyarray(mask)
+        if len(mask.shape) >= len(self.img.shape):
             mask = mask[..., 0]
 
-        self.mask = mask
-        self.data = np.ma.array(img_data, mask=np.repeat(
-            np.logical_not(mask[:, :, :, np.newaxis]),
-            img_data.shape[3], axis=3))
+        self.mask = mask.astype(bool)
+        self.voxel_idx = np.nonzero(self.mask)
+        self.data = data
 
     def get_image(self):
-        """A 3D numpy array with the image data, ignoring the mask."""
+        """A 4D numpy array with the image data, ignoring the mask."""
+
+        return DiffusionWeightedImage.get_image(self)
 
-        return self.data.data
+    def get_voxel_data(self):
+        """A 2D numpy array with one row of data per masked voxel.
+
+        Only the z-slices spanned by the mask are read.
+        """
+
+        x_idx, y_idx, z_idx = self.voxel_idx
+        if len(z_idx) == 0:
+            return np.zeros((0, self.img.shape[3]),
+                            dtype=self.img.get_data_dtype())
+
+        start = z_idx.min()
+        slab = self.get_slab(start, z_idx.max() + 1)
+        return slab[x_idx, y_idx, z_idx - start]
 
     def get_flat_data(self):
         """A 1D numpy array with only the masked data."""
-        return self.data.compressed()
+
+        return self.get_voxel_data().ravel()
+
+    def select_acquisitions(self, selection):
+        """A masked DWI containing only some of this image's acquisitions.
+
+        Nothing is read until the new image's data is accessed, and then
+        only the selected volumes are read.
+
+        Parameters
+        ----------
+        selection : array_like
+            Integer or logical index array of the acquisitions to
+            include, e.g. from ``b_selection``.
+
+        Returns
+        -------
+        MaskedDiffusionWeightedImage
+            The selected acquisitions, with the matching gradient table
+            and the same mask.
+        """
+
+        img, gtab = self._select_img_gtab(selection)
+        return MaskedDiffusionWeightedImage(
+            img, gtab, self.mask, lazy=self.lazy)
+
+class LabeledDiffusionWeightedImage(DiffusionWeightedImage):
+    """Wrapper class for a DWI containing several labeled phantoms.
+
+    The image data is loaded once and shared by every phantom, so views
+    of individual phantoms are cheap to create.
+
+    Parameters
+    ----------
+    img : SpatialImage
+        The NiBabel image of the DWI
+    gtab : GradientTable
+        The DIPY gradient table associated with the scan
+    labels : array_like
+        A 3D integer numpy array, where each phantom's voxels have a
+        distinct positive label and 0s indicate background.
+    """
+
+    def __init__(self, img, gtab, labels):
+        DiffusionWeightedImage.__init__(self, img, gtab)
+
+        labels = np.asanyarray(labels)
+        if len(labels.shape) >= len(self.img.shape):
+            labels = labels[..., 0]
+
+        self.labels = labels.astype(int)
+        self.data = np.asanyarray(self.img.dataobj)
+
+    def get_label_values(self):
+        """A sorted 1D numpy array of the labels present in the image."""
+
+        label_values = np.unique(self.labels)
+        return label_values[label_values > 0]
+
+    def get_phantom(self, label):
+        """A MaskedDiffusionWeightedImage view of one labeled phantom.
+
+        Parameters
+        ----------
+        label : int
+            The label of the phantom.
+
+        Returns
+        -------
+        MaskedDiffusionWeightedImage
+            The phantom's DWI, sharing this image's data.
+        """
+
+        return MaskedDiffusionWeightedImage(
+            self.img, self.gtab, self.labels == label, data=self.data)
+
+    def select_acquisitions(self, selection):
+        """A labeled DWI containing only some of this image's acquisitions.
+
+        Parameters
+        ----------
+        selection : array_like
+            Integer or logical index array of the acquisitions to
+            include, e.g. from ``b_selection``.
+
+        Returns
+        -------
+        LabeledDiffusionWeightedImage
+            The selected acquisitions, with the matching gradient table
+            and the same labels.
+        """
+
+        img, gtab = self._select_img_gtab(selection)
+        return LabeledDiffusionWeightedImage(img, gtab, self.labels)
+
+def label_masks(masks):
+    """Combine a sequence of binary masks into one labeled mask.
+
+    Parameters
+    ----------
+    masks : sequence of array_like
+        Binary masks of the same shape, each covering one phantom.
+
+    Returns
+    -------
+    array_like
+        An integer array where the voxels of the ith mask are labeled
+        i + 1, and all other voxels are 0.
+    """
+
+    labels = np.zeros(np.shape(masks[0]), dtype=int)
+
+    for idx, mask in enumerate(masks):
+        labels[np.asanyarray(mask).astype(bool)] = idx + 1
+
+    return labels
 
 def load_dwi(nifti_path, bval_path, bvec_path, mask_path=None,
-        b0_threshold=250):
+        b0_threshold=250, lazy=False):
     """Load the data needed to process a diffusion-weighted image.
 
     Parameters
@@ -83,9 +412,12 @@ def load_dwi(nifti_path, bval_path, bvec_path, mask_path=None,
     bvec_path : string
         Path to the .bvec file
     mask_path : string, optional
-        Path to the nifti mask, if one exists
+        Path to the mask, if one exists, as a nifti or from ``save_mask``
     b0_threshold
         Threshold below which a b-value is considered zero
+    lazy : bool, optional
+        True if the DWI data should only be read from disk as needed,
+        instead of being cached in memory.
 
     Returns
     -------
@@ -93,15 +425,44 @@ def load_dwi(nifti_path, bval_path, bvec_path, mask_path=None,
         The DWI data with a mask, if applicable.
     """
 
-    img = nib.load(nifti_path)
+    img = nib.load(nifti_path, mmap=True)
     bvals, bvecs = read_bvals_bvecs(bval_path, bvec_path)
     gtab = gradient_table(bvals, bvecs, b0_threshold=b0_threshold)
 
     if mask_path is not None:
-        mask = nib.load(mask_path)
-        return MaskedDiffusionWeightedImage(img, gtab, mask.get_data())
+        return MaskedDiffusionWeightedImage(
+            img, gtab, load_mask(mask_path), lazy=lazy)
     else:
-        return DiffusionWeightedImage(img, gtab)
+        return DiffusionWeightedImage(img, gtab, lazy)
+
+def load_labeled_dwi(nifti_path, bval_path, bvec_path, labels_path,
+        b0_threshold=250):
+    """Load a diffusion-weighted image with a labeled phantom mask.
+
+    Parameters
+    ----------
+    nifti_path : string
+        Path to the nifti DWI
+    bval_path : string
+        Path to the .bval file
+    bvec_path : string
+        Path to the .bvec file
+    labels_path : string
+        Path to the labeled mask, as a nifti or from ``save_mask``
+    b0_threshold
+        Threshold below which a b-value is considered zero
+
+    Returns
+    -------
+    img : LabeledDiffusionWeightedImage
+        The DWI data with its labeled mask.
+    """
+
+    img = nib.load(nifti_path)
+    bvals, bvecs = read_bvals_bvecs(bval_path, bvec_path)
+    gtab = gradient_table(bvals, bvecs=bvecs, b0_threshold=b0_threshold)
+
+    return LabeledDiffusionWeightedImage(img, gtab, load_mask(labels_path))
 
 class DerivedImage():
     """Wrapper class including an image of data derived from a DWI.
@@ -110,20 +471,45 @@ class DerivedImage():
     ----------
     img : SpatialImage
         The NiBabel image of the derived data.
+    lazy : bool, optional
+        True if the image data should be read from disk on every access
+        instead of being cached.
     """
 
-    def __init__(self, img):
+    def __init__(self, img, lazy=False):
         self.img = img
+        self.lazy = lazy
+        self.data = None
 
     def get_image(self):
         """A 3D numpy array with the image data."""
 
-        return self.img.get_data()
+        if self.data is not None:
+            return self.data
+
+        data = np.asanyarray(self.img.dataobj)
+        if not self.lazy:
+            self.data = data
+        return data
 
     def get_flat_data(self):
         """A 1D numpy array with the image data."""
 
-        return self.img.get_data().flatten()
+        return self.get_image().flatten()
+
+    def get_slab(self, start, stop):
+        """A numpy array with the image data from a range of z-slices.
+
+        Parameters
+        ----------
+        start, stop : int
+            The first z-slice to include, and the z-slice after the last.
+        """
+
+        if self.data is not None:
+            return self.data[:, :, start:stop]
+
+        return np.asanyarray(self.img.dataobj[:, :, start:stop])
 
 class MaskedDerivedImage(DerivedImage):
     """Wraps an image of data derived from a DWI with a mask.
@@ -134,33 +520,52 @@ class MaskedDerivedImage(DerivedImage):
         The NiBabel image of the derived data.
     mask : array_like
         A 3D binary numpy array, where 1s indicate voxels to be included.
+    lazy : bool, optional
+        True if the image data should be read from disk on every access
+        instead of being cached.
     """
 
-    def __init__(self, img, mask):
-        DerivedImage.__init__(self, img)
-        img_data = self.img.get_data()
+    def __init__(self, img, mask, lazy=False):
+        DerivedImage.__init__(self, img, lazy)
 
-        if len(img_data.shape) > 3:
-            img_data = img_data[..., 0]
+        mask = np.asanyarray(mask)
 
         # mask is often 4D for raw data
-        if len(mask.shape) > len(img_data.shape):
+        if len(mask.shape) > 3:
             mask = mask[..., 0]
 
-        self.mask = mask
-        self.data = np.ma.array(img_data, mask=np.logical_not(mask))
+        self.mask = mask.astype(bool)
+        self.voxel_idx = np.nonzero(self.mask)
 
     def get_image(self):
         """A 3D numpy array with the derived data, ignoring the mask."""
 
-        return self.data.data
+        img_data = DerivedImage.get_image(self)
+
+        if len(img_data.shape) > 3:
+            img_data = img_data[..., 0]
+
+        return img_data
 
     def get_flat_data(self):
-        """A 1D numpy array with the masked derived data."""
+        """A 1D numpy array with the masked derived data.
 
-        return self.data.compressed()
+        Only the z-slices spanned by the mask are read.
+        """
 
-def load_derived_image(image_path, mask_path=None):
+        x_idx, y_idx, z_idx = self.voxel_idx
+        if len(z_idx) == 0:
+            return np.zeros(0, dtype=self.img.get_data_dtype())
+
+        start = z_idx.min()
+        slab = self.get_slab(start, z_idx.max() + 1)
+
+        if len(slab.shape) > 3:
+            slab = slab[..., 0]
+
+        return slab[x_idx, y_idx, z_idx - start]
+
+def load_derived_image(image_path, mask_path=None, lazy=False):
     """Load the data from a derived image.
 
     Parameters
@@ -168,7 +573,10 @@ def load_derived_image(image_path, mask_path=None):
     image_path : string
         Path to the nifti derived data volume.
     mask_path : string, optional
-        Path to the nifti mask, if one exists
+        Path to the mask, if one exists, as a nifti or from ``save_mask``
+    lazy : bool, optional
+        True if the derived data should only be read from disk as
+        needed, instead of being cached in memory.
 
     Returns
     -------
@@ -176,15 +584,49 @@ def load_derived_image(image_path, mask_path=None):
         The derived data with a mask, if applicable.
     """
 
-    img = nib.load(image_path)
+    img = nib.load(image_path, mmap=True)
 
     if mask_path is not None:
-        mask = nib.load(mask_path)
-        return MaskedDerivedImage(img, mask.get_data())
+        return MaskedDerivedImage(img, load_mask(mask_path), lazy)
     else:
-        return DerivedImage(img)
+        return DerivedImage(img, lazy)
+
+GZIP_BLOCK_BYTES = 1 << 22
+
+def _gzip_block(block, compresslevel):
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, 31)
+    return compressor.compress(block) + compressor.flush()
+
+def _save_nifti(new_img, output_path, compresslevel=None, threads=1):
+    """Save a nifti image, optionally compressing it in parallel.
 
-def save_image(data, affine, output_path):
+    For .nii.gz paths with more than one thread, the serialized image is
+    split into blocks which are compressed concurrently as separate gzip
+    members. Concatenated gzip members form a valid gzip file, which
+    NiBabel reads as usual.
+    """
+
+    if not output_path.endswith('.gz') or (
+            threads == 1 and compresslevel is None):
+        nib.save(new_img, output_path)
+        return
+
+    if compresslevel is None:
+        compresslevel = nib.openers.Opener.default_compresslevel
+
+    raw = memoryview(new_img.to_bytes())
+    blocks = [raw[start:start + GZIP_BLOCK_BYTES]
+              for start in range(0, len(raw), GZIP_BLOCK_BYTES)]
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        members = executor.map(
+            _gzip_block, blocks, [compresslevel] * len(blocks))
+        with open(output_path, 'wb') as output_file:
+            for member in members:
+                output_file.write(member)
+
+def save_image(data, affine, output_path, dtype=None, compresslevel=None,
+        threads=1):
     """Save some data to a nifti file.
 
     Parameters
@@ -194,10 +636,205 @@ def save_image(data, affine, output_path):
     affine
         The affine transform to be used
     output_path : string
-        Path to the file to be saved 
+        Path to the file to be saved. Paths ending in .nii are saved
+        uncompressed, which is fastest.
+    dtype : data-type, optional
+        The data type to save with, e.g. np.float32 to halve the size of
+        float64 data.
+    compresslevel : int, optional
+        The gzip compression level (0-9) for .nii.gz files. Defaults to
+        NiBabel's default.
+    threads : int, optional
+        The number of threads with which to compress .nii.gz files, or
+        None to use every CPU.
+    """
+
+    if dtype is not None:
+        data = np.asarray(data).astype(dtype, copy=False)
+
+    new_img = nib.nifti1.Nifti1Image(data, affine)
+    _save_nifti(new_img, output_path, compresslevel, threads)
+
+def _as_mask(mask):
+    """Convert a mask or label image to an unsigned integer array."""
+
+    mask = np.asanyarray(mask)
+    if mask.dtype.kind == 'b':
+        return mask.astype(np.uint8)
+
+    if mask.dtype.kind != 'u':
+        with np.errstate(invalid='ignore'):
+            is_labels = (np.all(mask >= 0)
+                         and np.array_equal(mask, np.rint(mask)))
+        if not is_labels:
+            return (np.nan_to_num(mask) != 0).astype(np.uint8)
+
+    return mask.astype(np.min_scalar_type(int(mask.max(initial=0))),
+                       copy=False)
+
+def save_mask(mask, affine, output_path, packing='sparse'):
+    """Save a binary or labeled mask compactly.
+
+    Masks are stored as the smallest unsigned integer type holding their
+    labels (uint8 for binary masks); any mask that is not made of whole,
+    non-negative numbers is binarized first (see ``load_mask``). Masks
+    saved to nifti paths are stored as images. Masks saved to .npz paths
+    are either stored as the coordinates (and labels) of their nonzero
+    voxels, or, for binary masks, bit-packed.
+
+    Parameters
+    ----------
+    mask : array_like
+        The mask to be saved, where nonzero values indicate voxels to be
+        included.
+    affine
+        The affine transform to be used
+    output_path : string
+        Path to the file to be saved
+    packing : {'sparse', 'bits'}, optional
+        How .npz masks should be stored.
+    """
+
+    mask = _as_mask(mask)
+
+    if not output_path.endswith('.npz'):
+        save_image(mask, affine, output_path)
+        return
+
+    if packing == 'sparse':
+        coords = np.array(np.nonzero(mask))
+        coords = coords.astype(np.min_scalar_type(max(mask.shape)))
+        values = mask[tuple(coords)]
+        np.savez_compressed(output_path, shape=mask.shape, affine=affine,
+                            coords=coords, values=values)
+    elif packing == 'bits':
+        if mask.max(initial=0) > 1:
+            raise ValueError('Only binary masks can be bit-packed.')
+        np.savez_compressed(output_path, shape=mask.shape, affine=affine,
+                            bits=np.packbits(mask, axis=None))
+    else:
+        raise ValueError('Unknown mask packing: {}'.format(packing))
+
+def load_mask(mask_path):
+    """Load a mask saved as a nifti or with ``save_mask``.
+
+    Parameters
+    ----------
+    mask_path : string
+        Path to the mask.
+
+    Returns
+    -------
+    array_like
+        The mask, as an unsigned integer array. Masks holding whole,
+        non-negative numbers (e.g. labels) keep their values; any other
+        mask, e.g. one resampled to fractional values, is binarized,
+        with every nonzero voxel except NaNs included.
+    """
+
+    if not mask_path.endswith('.npz'):
+        return _as_mask(np.asanyarray(nib.load(mask_path).dataobj))
+
+    with np.load(mask_path) as packed:
+        shape = tuple(packed['shape'])
+
+        if 'bits' in packed.files:
+            bits = np.unpackbits(packed['bits'], count=int(np.prod(shape)))
+            return bits.reshape(shape)
+
+        mask = np.zeros(shape, dtype=packed['values'].dtype)
+        mask[tuple(packed['coords'].astype(np.intp))] = packed['values']
+        return mask
+
+def save_multi_image(images, affine, output_path, dtype=None,
+        compresslevel=None, threads=1):
+    """Save several named 3D images to one 4D nifti file.
+
+    The images are stacked along the fourth dimension, and their names
+    are stored as JSON in a comment extension of the nifti header.
+
+    Parameters
+    ----------
+    images : dict
+        Maps each image's name to its 3D data.
+    affine
+        The affine transform to be used
+    output_path : string
+        Path to the file to be saved
+    dtype, compresslevel, threads : optional
+        As for ``save_image``.
     """
+
+    names = list(images.keys())
+    data = np.stack([images[name] for name in names], axis=-1)
+    if dtype is not None:
+        data = data.astype(dtype, copy=False)
+
     new_img = nib.nifti1.Nifti1Image(data, affine)
-    nib.save(new_img, output_path)
+    new_img.header.extensions.append(nib.nifti1.Nifti1Extension(
+        'comment', json.dumps({'channels': names}).encode()))
+    _save_nifti(new_img, output_path, compresslevel, threads)
+
+def get_channel_names(img):
+    """Get the names of the channels of a 4D image.
+
+    Parameters
+    ----------
+    img : SpatialImage
+        A NiBabel image, usually saved with ``save_multi_image``.
+
+    Returns
+    -------
+    list of str
+        The name of each volume in the image. If the image has no
+        stored names, the volume indices are used.
+    """
+
+    for extension in img.header.extensions:
+        if extension.get_code() != 6:
+            continue
+        try:
+            return json.loads(extension.get_content().decode())['channels']
+        except (ValueError, KeyError, TypeError):
+            continue
+
+    return [str(idx) for idx in range(img.shape[3])]
+
+def load_multi_image(image_path, mask_path=None, lazy=False):
+    """Load each channel of a 4D nifti file as a derived image.
+
+    Parameters
+    ----------
+    image_path : string
+        Path to the nifti file, usually saved with ``save_multi_image``.
+    mask_path : string, optional
+        Path to the mask, if one exists, as a nifti or from ``save_mask``
+    lazy : bool, optional
+        True if each channel should only be read from disk as needed.
+
+    Returns
+    -------
+    dict
+        Maps each channel's name to its DerivedImage, with a mask if
+        applicable.
+    """
+
+    img = nib.load(image_path, mmap=True)
+
+    if mask_path is not None:
+        mask = load_mask(mask_path)
+
+    channels = {}
+    for idx, name in enumerate(get_channel_names(img)):
+        # Nothing is read until the channel's data is requested
+        channel_img = nib.Nifti1Image(
+            _VolumeSubset(img.dataobj, idx), img.affine, img.header)
+        if mask_path is not None:
+            channels[name] = MaskedDerivedImage(channel_img, mask, lazy)
+        else:
+            channels[name] = DerivedImage(channel_img, lazy)
+
+    return channels
 
 def gen_table(derived_images):
     """Organize the model outputs for a phantom in a table.
@@ -220,24 +857,73 @@ def gen_table(derived_images):
         # no input images, so just return empty table
         return np.array([])
 
-    for i in range(len(derived_images) - 1):
-        if not np.array_equal(
-                derived_images[i].mask, derived_images[i + 1].mask):
+    mask = np.asanyarray(derived_images[0].mask)
+
+    for img in derived_images[1:]:
+        if not np.array_equal(img.mask, mask):
             raise ValueError('Images must have the same mask.')
 
-    mask = derived_images[0].mask
+    mask = mask.astype(bool)
 
-    data_table = np.zeros([int(mask.sum()), len(derived_images)])
+    return np.stack([np.asanyarray(img.get_image())[mask]
+                     for img in derived_images], axis=1).astype(float)
 
-    col_idx = 0
+def gen_signal_table(dwi, labels, bins):
+    """Summarize the signal of each phantom in bins of acquisitions.
 
-    for m_idx, m_val in np.ndenumerate(mask):
-        if not m_val:
-            continue
+    The statistics of each phantom and bin are taken over all of its
+    voxel and acquisition samples together, so the standard deviation
+    includes the variation between acquisitions as well as between
+    voxels. The image is read once, and only the z-slices spanned by the
+    labels are read.
 
-        for idx, img in zip(range(len(derived_images)), derived_images):
-            data_table[col_idx, idx] = img.get_image()[m_idx]
+    Parameters
+    ----------
+    dwi : DiffusionWeightedImage
+        The DWI containing the phantoms.
+    labels : array_like
+        A 3D integer array, where each phantom's voxels have a distinct
+        positive label and 0s indicate background.
+    bins : array_like
+        A 2D logical array with one row per bin, indexing the
+        acquisitions in that bin, e.g. stacked results of
+        ``b_selection`` queries.
 
-        col_idx += 1
+    Returns
+    -------
+    array_like
+        A table with one row per phantom and bin, and columns for the
+        label, the bin's index, the number of voxels, and the mean,
+        median and standard deviation of the samples. Bins with no
+        acquisitions have NaN statistics.
+    """
 
-    return data_table
+    labels = np.asanyarray(labels).astype(int)
+    bins = np.atleast_2d(np.asanyarray(bins)).astype(bool)
+
+    x_idx, y_idx, z_idx = np.nonzero(labels > 0)
+    if len(z_idx) == 0:
+        return np.zeros((0, 6))
+
+    start = z_idx.min()
+    voxel_data = dwi.get_slab(start, z_idx.max() + 1)[
+        x_idx, y_idx, z_idx - start].astype(float)
+
+    voxel_labels = labels[x_idx, y_idx, z_idx]
+    order = np.argsort(voxel_labels, kind='stable')
+    label_values, label_starts, counts = np.unique(
+        voxel_labels[order], return_index=True, return_counts=True)
+    grouped = voxel_data[order]
+
+    rows = []
+    for label, label_start, count in zip(label_values, label_starts, counts):
+        phantom = grouped[label_start:label_start + count]
+        for bin_idx, acquisitions in enumerate(bins):
+            samples = phantom[:, acquisitions].ravel()
+            if samples.size == 0:
+                stats = [np.nan] * 3
+            else:
+                stats = [samples.mean(), np.median(samples), samples.std()]
+            rows.append([label, bin_idx, count] + stats)
+
+    return np.array(rows)
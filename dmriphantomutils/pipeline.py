@@ -0,0 +1,267 @@
+"""Run the full analysis of a phantom study.
+
+For each SingleScan in a Study, the pipeline loads the scan's DWI, masks
+each phantom's z-slice, fits a DKI model to the masked voxels, finds the
+phantom's centroid and fiducial, generates ground truth images from the
+phantom's infill pattern, and summarizes everything in a table.
+
+Every stage writes its outputs to disk, along with a stamp file
+recording the parameters it was run with. A stage is skipped if its
+outputs are newer than all of its inputs and its stamp matches its
+current parameters, so re-running the pipeline only redoes work whose
+inputs or settings have changed.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
+
+import numpy as np
+
+from dmriphantomutils import automask, dipy_fit, image_io, transform_data
+
+DKI_METRICS = ['fa', 'md', 'ad', 'rd', 'mk', 'ak', 'rk']
+
+def _describe(obj):
+    if hasattr(obj, '__dict__'):
+        return dict(vars(obj), type=type(obj).__name__)
+    return repr(obj)
+
+def _format_params(params):
+    return json.dumps(params, sort_keys=True, default=_describe)
+
+def write_stamp(stamp_path, params):
+    """Record the parameters with which a stage was run.
+
+    Parameters
+    ----------
+    stamp_path : str
+        Path to the stage's stamp file.
+    params : dict
+        The stage's parameters. Objects such as infill patterns are
+        recorded by their type and attributes.
+    """
+
+    with open(stamp_path, 'w') as stamp_file:
+        stamp_file.write(_format_params(params))
+
+def is_up_to_date(output_paths, input_paths, stamp_path=None, params=None):
+    """Check whether a stage's outputs are newer than all of its inputs.
+
+    Parameters
+    ----------
+    output_paths : collection of str
+        Paths to the files produced by the stage.
+    input_paths : collection of str
+        Paths to the files the stage depends on.
+    stamp_path : str, optional
+        Path to the stamp file written by ``write_stamp`` when the stage
+        was last run.
+    params : dict, optional
+        The stage's current parameters, which must match the stamp if
+        one is given.
+
+    Returns
+    -------
+    bool
+        True if every output exists, none is older than any input, and
+        the stamp matches the current parameters.
+    """
+
+    output_paths = list(output_paths)
+
+    if stamp_path is not None:
+        try:
+            with open(stamp_path) as stamp_file:
+                if stamp_file.read() != _format_params(params):
+                    return False
+        except FileNotFoundError:
+            return False
+        output_paths.append(stamp_path)
+
+    if not output_paths:
+        # A stage with nothing to produce never needs to run
+        return True
+
+    if not all(os.path.exists(path) for path in output_paths):
+        return False
+
+    newest_input = max(
+        (os.path.getmtime(path) for path in input_paths), default=0)
+    return min(
+        os.path.getmtime(path) for path in output_paths) >= newest_input
+
+def _load_array(path):
+    return image_io.load_derived_image(path).get_image()
+
+def _gen_truth(mask_path, md_path, slice_idx, generators, scaling, affine,
+        truth_paths):
+    mask = image_io.load_mask(mask_path)
+    md = _load_array(md_path) * (mask != 0)
+    centroid = transform_data.find_centroid(mask[..., slice_idx])
+    fiducial = np.unravel_index(np.argmax(md), md.shape)[0:2]
+
+    for metric, generator in generators.items():
+        truth = transform_data.gen_geometry_data(
+            mask, generator, centroid, scaling, fiducial=fiducial,
+            vectorized=True)
+        image_io.save_image(truth, affine, truth_paths[metric])
+
+def process_phantom(dwi, dwi_paths, slice_idx, phantom, output_dir,
+        blur=False):
+    """Run every pipeline stage for the phantom in one z-slice.
+
+    Parameters
+    ----------
+    dwi : DiffusionWeightedImage
+        The unmasked DWI containing the phantom.
+    dwi_paths : list of str
+        Paths to the DWI's nifti, .bval and .bvec files.
+    slice_idx : int
+        Index of the z-slice containing the phantom.
+    phantom : Phantom or WaterSlice
+        Description of the phantom in the slice.
+    output_dir : str
+        Directory to which the phantom's outputs should be saved.
+    blur : bool, optional
+        True if the image should be blurred before the model fit.
+
+    Returns
+    -------
+    str
+        Path to the phantom's summary table.
+    """
+
+    prefix = os.path.join(output_dir, 'slice_{}_'.format(slice_idx))
+    mask_path = prefix + 'mask.nii.gz'
+    metric_paths = {metric: prefix + metric + '.nii.gz'
+                    for metric in DKI_METRICS}
+    generators = phantom.infill_pattern.get_array_geometry_generators()
+    truth_paths = {metric: prefix + 'truth_' + metric + '.nii.gz'
+                   for metric in generators}
+    table_path = prefix + 'summary.tsv'
+    fit_stamp = prefix + 'fit.stamp'
+    fit_params = {'blur': blur}
+    truth_stamp = prefix + 'truth.stamp'
+    truth_params = {'pattern': phantom.infill_pattern}
+    affine = dwi.img.affine
+
+    if not is_up_to_date([mask_path], dwi_paths[:1]):
+        mask = np.zeros(dwi.img.shape[:3], dtype=np.uint8)
+        mask[..., slice_idx] = automask.mask_phantom(
+            dwi.get_slab(slice_idx, slice_idx + 1)[:, :, 0, 0])
+        image_io.save_mask(mask, affine, mask_path)
+
+    if not is_up_to_date(metric_paths.values(), dwi_paths + [mask_path],
+                         fit_stamp, fit_params):
+        masked_dwi = image_io.MaskedDiffusionWeightedImage(
+            dwi.img, dwi.gtab, image_io.load_mask(mask_path),
+            data=None if dwi.lazy else dwi.get_image(), lazy=dwi.lazy)
+        dkifit = dipy_fit.fit_dki(masked_dwi, blur, masked_only=True)
+        dipy_fit.save_dki_metric_imgs(
+            masked_dwi, dkifit,
+            **{metric + '_path': path
+               for metric, path in metric_paths.items()})
+        write_stamp(fit_stamp, fit_params)
+
+    if not is_up_to_date(
+            truth_paths.values(), [mask_path, metric_paths['md']],
+            truth_stamp, truth_params):
+        if generators:
+            _gen_truth(mask_path, metric_paths['md'], slice_idx, generators,
+                       dwi.img.header['pixdim'][1], affine, truth_paths)
+        write_stamp(truth_stamp, truth_params)
+
+    column_paths = dict(truth_paths, **metric_paths)
+    if not is_up_to_date(
+            [table_path],
+            list(column_paths.values()) + [mask_path, truth_stamp]):
+        data_table = image_io.gen_table(
+            [image_io.load_derived_image(path, mask_path=mask_path)
+             for path in column_paths.values()])
+        np.savetxt(table_path, data_table, delimiter='\t',
+                   header='\t'.join(column_paths.keys()), comments='')
+
+    return table_path
+
+def process_scan(nifti_path, bval_path, bvec_path, phantoms, output_dir,
+        blur=False):
+    """Run the pipeline for every phantom in one scan.
+
+    Parameters
+    ----------
+    nifti_path : str
+        Path to the nifti DWI
+    bval_path : str
+        Path to the .bval file
+    bvec_path : str
+        Path to the .bvec file
+    phantoms : list of Phantom or WaterSlice
+        The phantoms covered by the scan, where the ith phantom is in the
+        ith z-slice.
+    output_dir : str
+        Directory to which the scan's outputs should be saved.
+    blur : bool, optional
+        True if the image should be blurred before the model fit.
+
+    Returns
+    -------
+    list of str
+        Paths to each phantom's summary table.
+    """
+
+    os.makedirs(output_dir, exist_ok=True)
+    dwi_paths = [nifti_path, bval_path, bvec_path]
+    # Every read of a compressed image decompresses it from the start, so
+    # those are read once and cached instead
+    dwi = image_io.load_dwi(
+        *dwi_paths, lazy=not nifti_path.endswith('.gz'))
+
+    return [process_phantom(dwi, dwi_paths, slice_idx, phantom, output_dir,
+                            blur)
+            for slice_idx, phantom in enumerate(phantoms)]
+
+def run_study(study, locate_scan, output_dir, workers=None, blur=False):
+    """Run the pipeline for every scan in a study.
+
+    Scans are processed in parallel, one per worker process. Outputs for
+    each scan are saved in ``ses-XX/scan-XX`` subdirectories of the
+    output directory, numbered from 1 in the order of the study's
+    sessions and each session's scans.
+
+    Parameters
+    ----------
+    study : Study
+        The study to process.
+    locate_scan : function(ScanSession, SingleScan)
+        Function returning the paths to a scan's nifti, .bval and .bvec
+        files.
+    output_dir : str
+        Directory to which the study's outputs should be saved.
+    workers : int, optional
+        The number of worker processes. Defaults to the number of CPUs.
+    blur : bool, optional
+        True if the images should be blurred before the model fit.
+
+    Returns
+    -------
+    dict
+        Maps (session index, scan index) to a list of paths to each
+        phantom's summary table.
+    """
+
+    jobs = {}
+    for session_idx, session in enumerate(study.sessions):
+        for scan_idx, scan in enumerate(session.scans):
+            nifti_path, bval_path, bvec_path = locate_scan(session, scan)
+            scan_dir = os.path.join(
+                output_dir, 'ses-{:02d}'.format(session_idx + 1),
+                'scan-{:02d}'.format(scan_idx + 1))
+            jobs[(session_idx, scan_idx)] = (
+                nifti_path, bval_path, bvec_path,
+                study.tube[scan.tube_slice], scan_dir, blur)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {key: executor.submit(process_scan, *args)
+                   for key, args in jobs.items()}
+        return {key: future.result() for key, future in futures.items()}
@@ -109,6 +109,9 @@ class EmptyPattern:
     def get_geometry_generators(self):
         return {}
 
+    def get_array_geometry_generators(self):
+        return {}
+
 class ParallelLinePattern:
     """An infill pattern composed only of parallel lines.
 
@@ -132,9 +135,22 @@ class ParallelLinePattern:
         return {'direction': self._get_direction,
                 'crossing_angle': lambda point: 0}
 
+    def get_array_geometry_generators(self):
+        """A dictionary of functions that describe the infill geometry.
+
+        Each function takes an (N, 2) array of points and returns an (N,)
+        array with the value at each point.
+        """
+
+        return {'direction': self._get_directions,
+                'crossing_angle': lambda points: np.zeros(len(points))}
+
     def _get_direction(self, point):
         return 90 - self.cura_angle
 
+    def _get_directions(self, points):
+        return np.full(len(points), 90 - self.cura_angle, dtype=float)
+
 class ConcentricArcPattern:
     """An infill pattern composed of concentric arcs.
 
@@ -162,6 +178,17 @@ class ConcentricArcPattern:
                 'arc_radius': self._get_arc_radius,
                 'crossing_angle': lambda point: 0}
 
+    def get_array_geometry_generators(self):
+        """A dictionary of functions that describe the infill geometry.
+
+        Each function takes an (N, 2) array of points and returns an (N,)
+        array with the value at each point.
+        """
+
+        return {'direction': self._get_directions,
+                'arc_radius': self._get_arc_radii,
+                'crossing_angle': lambda points: np.zeros(len(points))}
+
     def _get_direction(self, point):
         displacement = (self.origin[0] - point[0], self.origin[1] - point[1])
         if displacement[0] == 0:
@@ -180,6 +207,22 @@ class ConcentricArcPattern:
 
         return np.linalg.norm(displacement)
 
+    def _get_directions(self, points):
+        displacement = np.array(self.origin) - np.asarray(points)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            disp_angle = np.degrees(
+                np.arctan(displacement[:, 1] / displacement[:, 0]))
+
+        directions = np.where(
+            disp_angle > 0, disp_angle - 90, disp_angle + 90)
+        return np.where(displacement[:, 0] == 0, 0, directions)
+
+    def _get_arc_radii(self, points):
+        displacement = np.array(self.origin) - np.asarray(points)
+
+        return np.linalg.norm(displacement, axis=1)
+
 class AlternatingPattern:
     """An infill pattern that changes from layer to layer.
 
@@ -203,6 +246,15 @@ class AlternatingPattern:
 
         return {'crossing_angle': self._get_crossing_angle}
 
+    def get_array_geometry_generators(self):
+        """A dictionary of functions that describe the infill geometry.
+
+        Each function takes an (N, 2) array of points and returns an (N,)
+        array with the value at each point.
+        """
+
+        return {'crossing_angle': self._get_crossing_angles}
+
     def _get_crossing_angle(self, point):
         patterns = [self.pattern_0, self.pattern_1]
         directions = [pattern.get_geometry_generators()['direction'](point)
@@ -215,3 +267,13 @@ class AlternatingPattern:
         else:
             return crossing_angle
 
+    def _get_crossing_angles(self, points):
+        patterns = [self.pattern_0, self.pattern_1]
+        directions = np.stack(
+            [pattern.get_array_geometry_generators()['direction'](points)
+             for pattern in patterns])
+
+        crossing_angle = directions.max(axis=0) - directions.min(axis=0)
+
+        return np.where(
+            crossing_angle > 90, 180 - crossing_angle, crossing_angle)
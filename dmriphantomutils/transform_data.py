@@ -10,11 +10,73 @@ negative y-axis. Then a translation and rotation can move each voxel's
 coordinates from image space to ground truth space.
 """
 
+from functools import lru_cache
 import warnings
 
 import numpy as np
-from skimage.morphology import binary_closing, disk
-from skimage.measure import label, regionprops
+import scipy.ndimage as ndi
+from skimage.morphology import disk
+
+@lru_cache(maxsize=None)
+def _get_closing_footprint(radius, ndim):
+    footprint = disk(radius).astype(bool)
+    return footprint.reshape(footprint.shape + (1,) * (ndim - 2))
+
+def find_centroids(labels, closing_radius=6):
+    """Find the centroids of every labeled phantom in a mask.
+
+    Each phantom's mask is closed to fill voxels that were masked out due
+    to air bubbles etc. Only a padded bounding box around each label is
+    processed, so many small phantoms in a large image are cheap.
+
+    Parameters
+    ----------
+    labels : array_like
+        A 2D or 3D integer array, where each phantom's voxels have a
+        distinct positive label (e.g. from ``automask.mask_phantoms``). A
+        binary mask is treated as a single phantom with label 1. 3D
+        masks are closed slice by slice.
+    closing_radius : int, optional
+        Radius of the disk used to close each phantom's mask.
+
+    Returns
+    -------
+    dict
+        Maps each label to a tuple of the coordinates of its centroid.
+        If a closed mask falls into several pieces, the centroid of the
+        first piece in raster order is used.
+    """
+
+    labels = np.asarray(labels)
+    if labels.dtype == bool:
+        labels = labels.astype(np.uint8)
+
+    footprint = _get_closing_footprint(closing_radius, labels.ndim)
+    # The dilation spreads up to one radius past the bounding box, and the
+    # erosion reads up to one radius past that
+    pad = 2 * closing_radius
+    pad_width = [pad, pad] + [0] * (labels.ndim - 2)
+    structure = np.ones((3,) * labels.ndim)
+
+    centroids = {}
+    for idx, bbox in enumerate(ndi.find_objects(labels)):
+        if bbox is None:
+            continue
+
+        crop = tuple(
+            slice(max(axis_slice.start - axis_pad, 0),
+                  axis_slice.stop + axis_pad)
+            for axis_slice, axis_pad in zip(bbox, pad_width))
+        closed = ndi.binary_erosion(
+            ndi.binary_dilation(labels[crop] == idx + 1, footprint),
+            footprint, border_value=1)
+        pieces, _ = ndi.label(closed, structure)
+        centroid = ndi.center_of_mass(closed, pieces, 1)
+        centroids[idx + 1] = tuple(
+            coord + axis_slice.start
+            for coord, axis_slice in zip(centroid, crop))
+
+    return centroids
 
 def find_centroid(mask):
     """Find the centroid of a phantom's mask.
@@ -31,9 +93,7 @@ def find_centroid(mask):
         A 1D array containing the coordinates of the mask's centroid.
     """
 
-    # Consider voxels that were masked out due to air bubbles etc.
-    closed_mask = label(binary_closing(mask, disk(6)))
-    return regionprops(closed_mask)[0].centroid
+    return find_centroids(np.asarray(mask) != 0)[1]
 
 def transform_image_point(point, centroid, angle=None, fiducial=None):
     """Perform a rigid transform of a given point.
@@ -87,10 +147,66 @@ def transform_image_point(point, centroid, angle=None, fiducial=None):
 
     return (rotated_point[0, 0], rotated_point[1, 0])
 
+def transform_image_points(points, centroid, angle=None, fiducial=None):
+    """Perform a rigid transform of many points at once.
+
+    This is the batched counterpart to ``transform_image_point``. The
+    rotation is computed once and applied to every point with a single
+    matrix product.
+
+    Parameters
+    ----------
+    points : array_like
+        An (N, 2) or (N, 3) array with the indices of the points to be
+        transformed in image space. Only the x and y indices are used.
+    centroid : tuple of float
+        The indices of the phantom's centroid in image space
+    angle : float, optional
+        The angle by which the phantom would need to be rotated to have
+        the fiducial at the bottom in the x-y plane. Exactly one of
+        angle or fiducial must be included as an argument.
+    fiducial : tuple of float, optional
+        The location of the fiducial in image space. Exactly one of
+        fiducial or angle must be included as an argument.
+
+    Returns
+    -------
+    array_like
+        An (N, 2) array with the corresponding indices of the original
+        points in ground truth space.
+    """
+
+    if angle is not None and fiducial is not None:
+        # Should only provide one. Default to using angle...
+        warnings.warn('Both angle ({}) and fiducial ({}) were provided to '
+                      'transform_image_points. Defaulting to angle.'.format(
+                          angle, fiducial))
+    elif fiducial is not None:
+        translated_fiducial = (np.array(fiducial[:2])
+                               - np.array(centroid[:2]))
+        angle = -90 - np.degrees(
+            np.arctan2(translated_fiducial[1], translated_fiducial[0]))
+    elif angle is None:
+        raise TypeError("Exactly one of angle or fiducial is required.")
+
+    translated_points = (np.asarray(points, dtype=float)[:, :2]
+                         - np.array(centroid[:2]))
+
+    theta = np.radians(angle)
+    rotation = np.array([[np.cos(theta), -1 * np.sin(theta)],
+                         [np.sin(theta), np.cos(theta)]])
+
+    return translated_points @ rotation.T
+
 def gen_geometry_data(mask_data, geometry_generator, centroid, scaling,
-        angle=None, fiducial=None):
+        angle=None, fiducial=None, vectorized=False):
     """Generate geometric ground truth data from a mask.
 
+    By default, each masked voxel is transformed and passed to the
+    geometry generator one at a time. In vectorized mode, all of the
+    masked voxels are gathered and transformed at once, and the
+    generator is called a single time with every transformed point.
+
     Parameters
     ----------
     mask_data : array_like 
@@ -108,6 +224,9 @@ def gen_geometry_data(mask_data, geometry_generator, centroid, scaling,
     fiducial : tuple of float, optional
         The location of the fiducial in image space. Exactly one of
         fiducial or angle must be included as an argument.
+    vectorized : bool, optional
+        True if the geometry generator accepts an (N, 2) array of points
+        and returns an (N,) array of values.
 
     Returns
     -------
@@ -129,6 +248,15 @@ def gen_geometry_data(mask_data, geometry_generator, centroid, scaling,
 
     geometry_data = np.zeros(mask_data.shape)
 
+    if vectorized:
+        x_idx, y_idx, z_idx = np.nonzero(mask_data)
+        transformed = transform_image_points(
+            np.stack([x_idx, y_idx], axis=1), centroid, angle=angle,
+            fiducial=fiducial) * scaling
+
+        geometry_data[x_idx, y_idx, z_idx] = geometry_generator(transformed)
+        return geometry_data
+
     for z in range(mask_data.shape[2]):
         for m_idx, m_val in np.ndenumerate(mask_data[..., z]):
             if m_val:
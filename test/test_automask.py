@@ -0,0 +1,123 @@
+import os.path
+import tempfile
+import unittest
+
+from dipy.core.gradients import gradient_table
+import nibabel as nib
+import numpy as np
+import skimage.filters as filters
+
+from dmriphantomutils import automask, image_io
+
+def gen_b0(n_slices=3):
+    x, y = np.meshgrid(np.arange(40), np.arange(40), indexing='ij')
+    img_b0 = np.random.uniform(0, 10, size=(40, 40, n_slices))
+
+    for slice_idx in range(n_slices):
+        disk = (x - 15 - 3 * slice_idx) ** 2 + (y - 20) ** 2 <= 100
+        img_b0[disk, slice_idx] += 500
+
+    return img_b0
+
+class TestAutomask(unittest.TestCase):
+    def test_threshold_otsu_stack(self):
+        img_b0 = gen_b0(4)
+        img_b0[..., 3] = 7
+
+        thresholds = automask.threshold_otsu_stack(img_b0)
+        for slice_idx in range(4):
+            self.assertAlmostEqual(
+                thresholds[slice_idx],
+                filters.threshold_otsu(img_b0[..., slice_idx]))
+
+    def test_threshold_otsu_stack_int(self):
+        img_b0 = np.round(gen_b0(4)).astype(np.int16)
+        img_b0[..., 1] -= 20
+        img_b0[..., 3] = 7
+
+        thresholds = automask.threshold_otsu_stack(img_b0)
+        for slice_idx in range(4):
+            self.assertEqual(
+                thresholds[slice_idx],
+                filters.threshold_otsu(img_b0[..., slice_idx]))
+
+        masks = automask.mask_phantom_stack(img_b0)
+        for slice_idx in range(3):
+            np.testing.assert_array_equal(
+                masks[..., slice_idx],
+                automask.mask_phantom(img_b0[..., slice_idx]))
+
+    def test_mask_phantom_stack(self):
+        img_b0 = gen_b0()
+
+        masks = automask.mask_phantom_stack(img_b0)
+        for slice_idx in range(3):
+            np.testing.assert_array_equal(
+                masks[..., slice_idx],
+                automask.mask_phantom(img_b0[..., slice_idx]))
+
+    def test_mask_phantoms(self):
+        img_b0 = gen_b0()
+
+        labels = automask.mask_phantoms(img_b0)
+        for slice_idx in range(3):
+            np.testing.assert_array_equal(
+                labels[..., slice_idx] == slice_idx + 1,
+                automask.mask_phantom(img_b0[..., slice_idx]))
+
+        parallel_labels = automask.mask_phantoms(
+            img_b0, slice_idxs=range(1, 3), workers=2)
+        self.assertFalse(parallel_labels[..., 0].any())
+        np.testing.assert_array_equal(
+            parallel_labels[..., 1:], labels[..., 1:])
+
+    def test_estimate_b0(self):
+        bvals = np.array([0, 1000, 100, 1000, 0, 2000])
+        bvecs = np.array([[0, 0, 0], [1, 0, 0], [1, 0, 0], [0, 1, 0],
+                          [0, 0, 0], [0, 0, 1]])
+        data = np.random.uniform(100, 300, size=(8, 8, 2, 6))
+        dwi = image_io.DiffusionWeightedImage(
+            nib.Nifti1Image(data, np.eye(4)),
+            gradient_table(bvals, bvecs=bvecs, b0_threshold=50), lazy=True)
+
+        np.testing.assert_allclose(
+            automask.estimate_b0(dwi), data[..., [0, 4]].mean(axis=3))
+        np.testing.assert_allclose(
+            automask.estimate_b0(dwi, statistic='median'),
+            np.median(data[..., [0, 4]], axis=3))
+        np.testing.assert_allclose(
+            automask.estimate_b0(dwi, b0_threshold=150),
+            data[..., [0, 2, 4]].mean(axis=3))
+
+        threshold_dwi = image_io.DiffusionWeightedImage(
+            nib.Nifti1Image(data, np.eye(4)),
+            gradient_table(bvals, bvecs=bvecs, b0_threshold=100), lazy=True)
+        np.testing.assert_allclose(
+            automask.estimate_b0(threshold_dwi),
+            data[..., [0, 2, 4]].mean(axis=3))
+
+        with self.assertRaises(ValueError):
+            automask.estimate_b0(dwi, statistic='mode')
+        with self.assertRaises(ValueError):
+            automask.estimate_b0(dwi, b0_threshold=-1)
+
+    def test_load_b0(self):
+        bvals = np.array([0, 1000, 250, 1000, 2000])
+        bvecs = np.array([[0, 0, 0], [1, 0, 0], [0, 1, 0], [0, 1, 0],
+                          [0, 0, 1]])
+        data = np.random.uniform(100, 300, size=(8, 8, 2, 5))
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            paths = [os.path.join(tmp_dir, name)
+                     for name in ['dwi.nii', 'dwi.bval', 'dwi.bvec']]
+            nib.save(nib.Nifti1Image(data, np.eye(4)), paths[0])
+            np.savetxt(paths[1], bvals[np.newaxis])
+            np.savetxt(paths[2], bvecs.T)
+
+            # A volume exactly at the threshold is a b0, as in the gtab
+            _, img_b0 = automask.load_b0(*paths, b0_threshold=250)
+            np.testing.assert_allclose(
+                img_b0, data[..., [0, 2]].mean(axis=3))
+
+            _, img_b0 = automask.load_b0(paths[0])
+            np.testing.assert_allclose(img_b0, data[..., 0])
@@ -0,0 +1,72 @@
+import unittest
+
+from dipy.core.gradients import gradient_table
+import numpy as np
+
+from dmriphantomutils import b_selection
+
+class TestBSelection(unittest.TestCase):
+    def test_get_acquisitions_by_bval(self):
+        bvals = np.array([0, 5, 1000, 995, 2000])
+        np.testing.assert_array_equal(
+            b_selection.get_acquisitions_by_bval(bvals, 900, 1100),
+            [False, False, True, True, False])
+
+    def test_get_acquisitions_by_dirs(self):
+        bvecs = np.array([[0, 0, 0], [1, 0, 0], [-1, 0, 0], [0, 1, 0],
+                          [0, 0, 1], [1, 1, 0]])
+
+        selection = b_selection.get_acquisitions_by_dirs(
+            bvecs, [0, 90, 45], [90, 90, 90], [10, 10, 50])
+        np.testing.assert_array_equal(
+            selection,
+            [[False, True, True, False, False, False],
+             [False, False, False, True, False, False],
+             [False, True, True, True, False, True]])
+
+        for row, (phi, theta) in enumerate([(0, 90), (90, 90)]):
+            np.testing.assert_array_equal(
+                b_selection.get_acquisitions_by_dir(bvecs, phi, theta, 10),
+                selection[row])
+
+        np.testing.assert_array_equal(
+            b_selection.get_acquisitions_by_dirs(bvecs, [0], [0], 10),
+            [[False, False, False, False, True, False]])
+
+    def test_gradient_index(self):
+        bvals = np.concatenate([np.zeros(3), 1000 + np.arange(-10, 10),
+                                2000 + np.arange(-10, 10)])
+        bvecs = np.random.normal(size=(43, 3))
+        bvecs /= np.linalg.norm(bvecs, axis=1)[:, np.newaxis]
+        bvecs[:3] = 0
+        index = b_selection.GradientIndex(gradient_table(bvals, bvecs=bvecs))
+
+        np.testing.assert_allclose(index.shells, [0, 999.5, 1999.5])
+        np.testing.assert_array_equal(
+            index.get_acquisitions_by_shell(1000),
+            b_selection.get_acquisitions_by_bval(bvals, 500, 1500))
+        np.testing.assert_array_equal(
+            index.get_acquisitions_by_bval(995, 1995),
+            b_selection.get_acquisitions_by_bval(bvals, 995, 1995))
+
+        phi = np.random.uniform(-180, 180, size=20)
+        theta = np.random.uniform(0, 180, size=20)
+        np.testing.assert_array_equal(
+            index.get_acquisitions_by_dirs(phi, theta, 30),
+            b_selection.get_acquisitions_by_dirs(bvecs, phi, theta, 30))
+        np.testing.assert_array_equal(
+            index.get_acquisitions_by_dir(phi[0], theta[0], 30),
+            b_selection.get_acquisitions_by_dir(bvecs, phi[0], theta[0], 30))
+
+    def test_gradient_index_boundary(self):
+        bvals = np.array([0, 1000, 1000, 1000])
+        bvecs = np.array([[0, 0, 0], [1, 0, 0], [0, 1, 0], [0, 0, 1]])
+        index = b_selection.GradientIndex(gradient_table(bvals, bvecs=bvecs))
+
+        for tolerance in [45, 45.001]:
+            np.testing.assert_array_equal(
+                index.get_acquisitions_by_dir(45, 90, tolerance),
+                b_selection.get_acquisitions_by_dir(
+                    bvecs, 45, 90, tolerance))
+        self.assertFalse(index.get_acquisitions_by_dir(45, 90, 45).any())
+
@@ -35,6 +35,9 @@ class MockDiffusionWeightedImage():
     def get_flat_data(self):
         return self.data.flatten()
 
+    def get_slab(self, start, stop):
+        return self.data[:, :, start:stop]
+
 class MockDerivedImage():
     def __init__(self, data=None, mask=None):
         if data is None:
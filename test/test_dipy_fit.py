@@ -1,13 +1,151 @@
 import os.path
 import tempfile
 import unittest
+from unittest import mock
 
-from dmriphantomutils import dipy_fit
+import nibabel as nib
+import numpy as np
+
+from dmriphantomutils import dipy_fit, fit_cache, image_io
 from test import test_data
 
 class TestDipyFit(unittest.TestCase):
+    def setUp(self):
+        self.mask = np.zeros([50, 50, 3])
+        self.mask[10:20, 25:40, 1] = 1
+        self.dwi = test_data.MockDiffusionWeightedImage(mask=self.mask)
+
     def testFitDki(self):
         dwi = test_data.MockDiffusionWeightedImage()
 
         dkifit = dipy_fit.fit_dki(dwi)
 
+
+    def test_fit_masked_only(self):
+        for blur in [False, True]:
+            dkifit = dipy_fit.fit_dki(self.dwi, blur)
+            masked_dkifit = dipy_fit.fit_dki(
+                self.dwi, blur, masked_only=True)
+            np.testing.assert_allclose(masked_dkifit.fa, dkifit.fa)
+            np.testing.assert_allclose(
+                masked_dkifit.mk(min_kurtosis=0), dkifit.mk(min_kurtosis=0))
+            self.assertEqual(masked_dkifit.model_params.shape,
+                             dkifit.model_params.shape)
+
+        dtifit = dipy_fit.fit_dti(self.dwi)
+        masked_dtifit = dipy_fit.fit_dti(self.dwi, masked_only=True)
+        np.testing.assert_allclose(masked_dtifit.md, dtifit.md)
+        self.assertEqual(masked_dtifit.fit.model_params.shape, (150, 12))
+
+    def test_get_voxel_data_unmasked(self):
+        dwi = image_io.DiffusionWeightedImage(
+            nib.Nifti1Image(self.dwi.data, np.eye(4)), self.dwi.gtab,
+            lazy=True)
+
+        # Only slabs should be read, never the whole image
+        with mock.patch.object(dwi, 'get_image', side_effect=AssertionError):
+            voxel_data, mask = dipy_fit.get_voxel_data(dwi)
+        self.assertTrue(mask.all())
+        np.testing.assert_allclose(
+            voxel_data, self.dwi.data.reshape(-1, self.dwi.data.shape[3]))
+
+    def test_fit_dki_parallel(self):
+        dkifit = dipy_fit.fit_dki(self.dwi, masked_only=True)
+        parallel_dkifit = dipy_fit.fit_dki(self.dwi, workers=2)
+        np.testing.assert_allclose(
+            parallel_dkifit.model_params, dkifit.model_params)
+        np.testing.assert_allclose(
+            parallel_dkifit.ak(min_kurtosis=0), dkifit.ak(min_kurtosis=0))
+
+    def test_fit_dti_dki(self):
+        dtifit, dkifit = dipy_fit.fit_dti_dki(self.dwi)
+        np.testing.assert_allclose(
+            dkifit.model_params,
+            dipy_fit.fit_dki(self.dwi, masked_only=True).model_params)
+        np.testing.assert_allclose(
+            dtifit.md, dipy_fit.fit_dti(self.dwi, masked_only=True).md)
+
+        low_b_dtifit, _ = dipy_fit.fit_dti_dki(
+            self.dwi, dti_bval_threshold=1000)
+        dti_idx = self.dwi.gtab.bvals <= 1000
+        low_b_dwi = test_data.MockDiffusionWeightedImage(
+            data=self.dwi.data[..., dti_idx],
+            gtab=image_io.select_gtab(self.dwi.gtab, dti_idx),
+            mask=self.mask)
+        np.testing.assert_allclose(
+            low_b_dtifit.fa, dipy_fit.fit_dti(low_b_dwi, masked_only=True).fa)
+
+    def test_fit_dki_cached(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache = fit_cache.FitCache(tmp_dir)
+            dkifit = dipy_fit.fit_dki_cached(
+                self.dwi, cache, 'key', masked_only=True)
+            cached_dkifit = dipy_fit.fit_dki_cached(
+                test_data.MockDiffusionWeightedImage(), cache, 'key')
+
+            np.testing.assert_array_equal(
+                cached_dkifit.model_params, dkifit.model_params)
+            np.testing.assert_array_equal(cached_dkifit.mask, dkifit.mask)
+
+    def test_stream_dki_metric_imgs(self):
+        mask = np.zeros([50, 50, 3])
+        mask[10:20, 25:40, 0] = 1
+        mask[30:40, 5:15, 2] = 1
+        mock_dwi = test_data.MockDiffusionWeightedImage(mask=mask)
+        dwi = image_io.MaskedDiffusionWeightedImage(
+            nib.Nifti1Image(mock_dwi.data, np.eye(4)), mock_dwi.gtab, mask)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for blur in [False, True]:
+                paths = {metric + '_path': os.path.join(
+                             tmp_dir, '{}_{}.nii'.format(metric, blur))
+                         for metric in ['md', 'mk']}
+                dipy_fit.stream_dki_metric_imgs(dwi, blur, **paths)
+
+                dkifit = dipy_fit.fit_dki(dwi, blur, masked_only=True)
+                np.testing.assert_allclose(
+                    nib.load(paths['md_path']).get_fdata(), dkifit.md)
+                np.testing.assert_allclose(
+                    nib.load(paths['mk_path']).get_fdata(),
+                    dkifit.mk(min_kurtosis=0))
+
+    def test_main_stream_options(self):
+        for options in [{'workers': 2}, {'cache_dir': 'cache'},
+                        {'container_path': 'metrics.nii.gz'}]:
+            with self.assertRaises(ValueError):
+                dipy_fit.main('dwi.nii', 'dwi.bval', 'dwi.bvec',
+                              stream=True, **options)
+
+    def test_compute_metrics(self):
+        for dkifit in [dipy_fit.fit_dki(self.dwi),
+                       dipy_fit.fit_dki(self.dwi, masked_only=True)]:
+            metrics = dipy_fit.compute_metrics(dkifit)
+            self.assertEqual(set(metrics.keys()), set(dipy_fit.DKI_METRICS))
+            for metric in dipy_fit.DTI_METRICS:
+                np.testing.assert_allclose(
+                    metrics[metric], getattr(dkifit, metric))
+            for metric in ['mk', 'ak', 'rk']:
+                np.testing.assert_allclose(
+                    metrics[metric],
+                    getattr(dkifit, metric)(min_kurtosis=0))
+
+        dtifit = dipy_fit.fit_dti(self.dwi)
+        metrics = dipy_fit.compute_metrics(dtifit, ['fa', 'rd'])
+        self.assertEqual(set(metrics.keys()), {'fa', 'rd'})
+        np.testing.assert_allclose(metrics['fa'], dtifit.fa)
+
+    def test_save_metric_container(self):
+        dwi = image_io.MaskedDiffusionWeightedImage(
+            nib.Nifti1Image(self.dwi.data, np.eye(4)), self.dwi.gtab,
+            self.mask)
+        dkifit = dipy_fit.fit_dki(dwi, masked_only=True)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'metrics.nii.gz')
+            dipy_fit.save_metric_container(dwi, dkifit, path)
+
+            channels = image_io.load_multi_image(path)
+            self.assertEqual(list(channels.keys()),
+                             list(dipy_fit.DKI_METRICS))
+            np.testing.assert_allclose(
+                channels['rk'].get_image(), dkifit.rk(min_kurtosis=0))
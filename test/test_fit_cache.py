@@ -0,0 +1,69 @@
+import os
+import os.path
+import tempfile
+import unittest
+
+import numpy as np
+
+from dmriphantomutils import fit_cache
+
+class TestFitCache(unittest.TestCase):
+    def test_hash_inputs(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'input.txt')
+            with open(path, 'w') as input_file:
+                input_file.write('abc')
+
+            key = fit_cache.hash_inputs([path, None], blur=False)
+            self.assertEqual(
+                key, fit_cache.hash_inputs([path, None], blur=False))
+            self.assertNotEqual(
+                key, fit_cache.hash_inputs([path, None], blur=True))
+            self.assertNotEqual(key, fit_cache.hash_inputs([path]))
+
+            with open(path, 'w') as input_file:
+                input_file.write('abd')
+            self.assertNotEqual(
+                key, fit_cache.hash_inputs([path, None], blur=False))
+
+    def test_get_put(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache = fit_cache.FitCache(tmp_dir)
+            self.assertIsNone(cache.get('missing'))
+
+            cache.put('key', model_params=np.arange(6).reshape(2, 3))
+            np.testing.assert_array_equal(
+                cache.get('key')['model_params'], np.arange(6).reshape(2, 3))
+
+    def test_evict(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            params = np.zeros(1000)
+            cache = fit_cache.FitCache(tmp_dir, max_bytes=20000)
+
+            for idx, key in enumerate(['a', 'b']):
+                cache.put(key, model_params=params)
+                os.utime(os.path.join(tmp_dir, key + '.npz'), (idx, idx))
+
+            # Using 'a' makes 'b' the least recently used entry
+            cache.get('a')
+            cache.put('c', model_params=params)
+
+            self.assertIsNotNone(cache.get('a'))
+            self.assertIsNone(cache.get('b'))
+            self.assertIsNotNone(cache.get('c'))
+
+    def test_corrupt_and_partial_entries(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache = fit_cache.FitCache(tmp_dir, max_bytes=0)
+
+            with open(os.path.join(tmp_dir, 'bad.npz'), 'wb') as bad_file:
+                bad_file.write(b'not a zip file')
+            self.assertIsNone(cache.get('bad'))
+
+            # An entry still being written by another process
+            partial_path = os.path.join(tmp_dir, 'partial.tmp')
+            with open(partial_path, 'wb') as partial_file:
+                partial_file.write(b'\0' * 1000)
+            cache.evict()
+            self.assertTrue(os.path.exists(partial_path))
+            self.assertFalse(os.path.exists(os.path.join(tmp_dir, 'bad.npz')))
@@ -1,9 +1,221 @@
+import os.path
+import tempfile
 import unittest
+from unittest import mock
+
+import nibabel as nib
+import numpy as np
 
 from dmriphantomutils import image_io
 from test import test_data
 
 class TestImageIo(unittest.TestCase):
+    def test_masked_dwi(self):
+        mock_dwi = test_data.MockDiffusionWeightedImage(
+            data=np.random.uniform(100, 300, size=(10, 10, 3, 12)))
+        mask = np.zeros([10, 10, 3])
+        mask[2:6, 3:8, 1] = 1
+
+        dwi = image_io.MaskedDiffusionWeightedImage(
+            nib.Nifti1Image(mock_dwi.data, np.eye(4)), mock_dwi.gtab, mask)
+
+        expected = np.ma.array(mock_dwi.data, mask=np.repeat(
+            np.logical_not(mask[..., np.newaxis]), 12, axis=3))
+        np.testing.assert_array_equal(dwi.get_image(), mock_dwi.data)
+        np.testing.assert_array_equal(
+            dwi.get_flat_data(), expected.compressed())
+        self.assertEqual(dwi.get_voxel_data().shape, (20, 12))
+
+    def test_labeled_dwi(self):
+        mock_dwi = test_data.MockDiffusionWeightedImage(
+            data=np.random.uniform(100, 300, size=(10, 10, 3, 12)))
+        masks = [np.zeros([10, 10, 3]) for _ in range(3)]
+        for z_slice, mask in enumerate(masks):
+            mask[2:6, 3:8, z_slice] = 1
+        labels = image_io.label_masks(masks)
+        self.assertEqual(labels[3, 4, 2], 3)
+        self.assertEqual(labels[0, 0, 2], 0)
+
+        img = nib.Nifti1Image(mock_dwi.data, np.eye(4))
+        labeled_dwi = image_io.LabeledDiffusionWeightedImage(
+            img, mock_dwi.gtab, labels)
+        np.testing.assert_array_equal(
+            labeled_dwi.get_label_values(), [1, 2, 3])
+
+        for label, mask in zip(labeled_dwi.get_label_values(), masks):
+            phantom = labeled_dwi.get_phantom(label)
+            self.assertIs(phantom.get_image(), labeled_dwi.get_image())
+            np.testing.assert_array_equal(
+                phantom.get_flat_data(),
+                image_io.MaskedDiffusionWeightedImage(
+                    img, mock_dwi.gtab, mask).get_flat_data())
+
+    def test_lazy_loading(self):
+        data = np.random.uniform(100, 300, size=(10, 10, 3, 12))
+        mask = np.zeros([10, 10, 3])
+        mask[2:6, 3:8, 1] = 1
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            paths = [os.path.join(tmp_dir, name) for name in
+                     ['dwi.nii', 'dwi.bval', 'dwi.bvec', 'mask.nii']]
+            nib.save(nib.Nifti1Image(data, np.eye(4)), paths[0])
+            np.savetxt(paths[1], np.linspace(0, 2000, 12)[np.newaxis])
+            np.savetxt(paths[2], np.tile([[1], [0], [0]], 12))
+            nib.save(nib.Nifti1Image(mask, np.eye(4)), paths[3])
+
+            lazy_dwi = image_io.load_dwi(*paths[:3], lazy=True)
+            np.testing.assert_allclose(
+                lazy_dwi.get_slab(1, 3), data[:, :, 1:3])
+            np.testing.assert_allclose(
+                lazy_dwi.get_volumes([0, 5]), data[..., [0, 5]])
+            np.testing.assert_allclose(lazy_dwi.get_image(), data)
+            self.assertIsNone(lazy_dwi.data)
+
+            masked_dwi = image_io.load_dwi(*paths, lazy=True)
+            np.testing.assert_allclose(
+                masked_dwi.get_voxel_data(), data[mask == 1])
+
+            eager_dwi = image_io.load_dwi(*paths)
+            np.testing.assert_allclose(
+                eager_dwi.get_slab(1, 3), data[:, :, 1:3])
+            self.assertIsNotNone(eager_dwi.data)
+
+            gz_path = os.path.join(tmp_dir, 'dwi.nii.gz')
+            nib.save(nib.Nifti1Image(data, np.eye(4)), gz_path)
+            gz_dwi = image_io.load_dwi(gz_path, *paths[1:3], lazy=True)
+            np.testing.assert_allclose(
+                gz_dwi.get_volumes([7, 2, 5]), data[..., [7, 2, 5]])
+            np.testing.assert_allclose(
+                gz_dwi.select_acquisitions([9, 3]).get_slab(0, 2),
+                data[:, :, 0:2][..., [9, 3]])
+
+            nib.save(nib.Nifti1Image(data[..., 0], np.eye(4)), paths[0])
+            derived = image_io.load_derived_image(
+                paths[0], mask_path=paths[3], lazy=True)
+            np.testing.assert_allclose(
+                derived.get_flat_data(), data[..., 0][mask == 1])
+            self.assertIsNone(derived.data)
+
+    def test_read_volumes(self):
+        data = np.random.uniform(100, 300, size=(6, 6, 2, 12))
+        bvals = np.linspace(0, 2000, 12)
+        selection = [0, 2, 3, 4, 11]
+        read_keys = []
+        getitem = nib.arrayproxy.ArrayProxy.__getitem__
+
+        def record_read(proxy, key):
+            read_keys.append(key)
+            return getitem(proxy, key)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            paths = [os.path.join(tmp_dir, name) for name in
+                     ['dwi.nii', 'dwi.bval', 'dwi.bvec', 'dwi.nii.gz']]
+            nib.save(nib.Nifti1Image(data, np.eye(4)), paths[0])
+            nib.save(nib.Nifti1Image(data, np.eye(4)), paths[3])
+            np.savetxt(paths[1], bvals[np.newaxis])
+            np.savetxt(paths[2], np.tile([[1], [0], [0]], 12))
+
+            with mock.patch.object(nib.arrayproxy.ArrayProxy, '__getitem__',
+                                   record_read):
+                dwi = image_io.load_dwi(*paths[:3], lazy=True)
+                np.testing.assert_allclose(
+                    dwi.get_volumes(selection), data[..., selection])
+                # Uncompressed files read only the selected volumes, one
+                # run of consecutive volumes at a time
+                self.assertEqual([key[-1] for key in read_keys],
+                                 [slice(0, 1), slice(2, 5), slice(11, 12)])
+
+                read_keys.clear()
+                np.testing.assert_allclose(
+                    dwi.select_acquisitions(selection).get_slab(1, 2),
+                    data[:, :, 1:2][..., selection])
+                self.assertEqual(
+                    sum(key[-1].stop - key[-1].start for key in read_keys),
+                    len(selection))
+
+                read_keys.clear()
+                gz_dwi = image_io.load_dwi(paths[3], *paths[1:3], lazy=True)
+                np.testing.assert_allclose(
+                    gz_dwi.get_volumes(selection), data[..., selection])
+                # Compressed files are read once
+                self.assertEqual(len(read_keys), 1)
+
+            self.assertEqual(dwi.get_volumes([]).shape, (6, 6, 2, 0))
+
+    def test_select_acquisitions(self):
+        data = np.random.uniform(100, 300, size=(10, 10, 3, 12))
+        bvals = np.linspace(0, 2000, 12)
+        mask = np.zeros([10, 10, 3])
+        mask[2:6, 3:8, 1] = 1
+        selection = bvals > 1000
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            paths = [os.path.join(tmp_dir, name) for name in
+                     ['dwi.nii', 'dwi.bval', 'dwi.bvec', 'mask.nii']]
+            nib.save(nib.Nifti1Image(data, np.eye(4)), paths[0])
+            np.savetxt(paths[1], bvals[np.newaxis])
+            np.savetxt(paths[2], np.tile([[1], [0], [0]], 12))
+            nib.save(nib.Nifti1Image(mask, np.eye(4)), paths[3])
+
+            dwi = image_io.load_dwi(*paths[:3], lazy=True)
+            subset = dwi.select_acquisitions(selection)
+            self.assertEqual(subset.img.shape, (10, 10, 3, 6))
+            np.testing.assert_allclose(subset.gtab.bvals, bvals[selection])
+            np.testing.assert_allclose(
+                subset.get_slab(1, 2), data[:, :, 1:2][..., selection])
+            np.testing.assert_allclose(
+                subset.get_volumes([1, 2]), data[..., selection][..., [1, 2]])
+            np.testing.assert_allclose(
+                subset.get_image(), data[..., selection])
+            self.assertIsNone(dwi.data)
+
+            masked_subset = image_io.load_dwi(*paths).select_acquisitions(
+                [0, 3])
+            np.testing.assert_allclose(
+                masked_subset.get_voxel_data(), data[mask == 1][:, [0, 3]])
+
+            labeled_subset = image_io.LabeledDiffusionWeightedImage(
+                dwi.img, dwi.gtab, mask).select_acquisitions(selection)
+            np.testing.assert_allclose(
+                labeled_subset.get_phantom(1).get_voxel_data(),
+                data[mask == 1][:, selection])
+
+            self.assertEqual(
+                dwi.select_acquisitions([]).get_image().shape,
+                (10, 10, 3, 0))
+
+    def test_multi_image(self):
+        images = {'md': np.random.uniform(size=(5, 5, 2)),
+                  'mk': np.random.uniform(size=(5, 5, 2))}
+        mask = np.zeros([5, 5, 2])
+        mask[1:3, 2:4, 1] = 1
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            image_path = os.path.join(tmp_dir, 'metrics.nii.gz')
+            mask_path = os.path.join(tmp_dir, 'mask.nii.gz')
+            image_io.save_multi_image(images, np.eye(4), image_path)
+            image_io.save_image(mask, np.eye(4), mask_path)
+
+            with mock.patch.object(nib.arrayproxy.ArrayProxy, '__getitem__',
+                                   side_effect=AssertionError):
+                channels = image_io.load_multi_image(image_path, lazy=True)
+            self.assertEqual(list(channels.keys()), ['md', 'mk'])
+            self.assertEqual(channels['mk'].img.shape, (5, 5, 2))
+            np.testing.assert_allclose(
+                channels['mk'].get_slab(1, 2), images['mk'][:, :, 1:2])
+            self.assertIsNone(channels['mk'].data)
+
+            channels = image_io.load_multi_image(image_path)
+            for name, img in channels.items():
+                np.testing.assert_allclose(img.get_image(), images[name])
+
+            masked_channels = image_io.load_multi_image(
+                image_path, mask_path=mask_path)
+            table = image_io.gen_table(list(masked_channels.values()))
+            np.testing.assert_allclose(
+                table, np.stack([images['md'][mask == 1],
+                                 images['mk'][mask == 1]], axis=1))
+
     def test_gen_table(self):
         self.assertEqual(image_io.gen_table([]).shape, (0,))
 
@@ -13,9 +225,132 @@ class TestImageIo(unittest.TestCase):
         table_1 = image_io.gen_table([image_1, image_2])
         self.assertEqual(table_1.shape, (317, 2))
 
+        image_2.data = image_2.data ** 2
+        table_2 = image_io.gen_table([image_1, image_2])
+        expected = [[image_1.data[idx], image_2.data[idx]]
+                    for idx, val in np.ndenumerate(image_1.mask) if val]
+        np.testing.assert_array_equal(table_2, expected)
+
         image_2.mask[0, 0, 1] = 1
 
         with self.assertRaises(ValueError) as e:
             image_io.gen_table([image_1, image_2])
 
             assertEqual(e.msg[:5], 'Image')
+
+    def test_save_image(self):
+        data = np.random.uniform(size=(64, 64, 8))
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'image.nii.gz')
+
+            image_io.save_image(data, np.eye(4), path, dtype=np.float32)
+            img = nib.load(path)
+            self.assertEqual(img.get_data_dtype(), np.float32)
+            np.testing.assert_allclose(img.get_fdata(), data, rtol=1e-6)
+
+            image_io.GZIP_BLOCK_BYTES, block_bytes = (
+                1 << 12, image_io.GZIP_BLOCK_BYTES)
+            try:
+                image_io.save_image(data, np.eye(4), path, threads=4,
+                                    compresslevel=6)
+            finally:
+                image_io.GZIP_BLOCK_BYTES = block_bytes
+            np.testing.assert_array_equal(nib.load(path).get_fdata(), data)
+
+    def test_save_mask(self):
+        labels = np.zeros([20, 20, 3], dtype=int)
+        labels[2:6, 3:8, 0] = 1
+        labels[10:15, 3:8, 2] = 2
+        mask = labels > 0
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for name, packing in [('mask.nii.gz', 'sparse'),
+                                  ('mask.npz', 'sparse'),
+                                  ('mask.npz', 'bits')]:
+                path = os.path.join(tmp_dir, name)
+                image_io.save_mask(mask, np.eye(4), path, packing=packing)
+                loaded = image_io.load_mask(path)
+                self.assertEqual(loaded.dtype, np.uint8)
+                np.testing.assert_array_equal(loaded, mask)
+
+            path = os.path.join(tmp_dir, 'labels.npz')
+            image_io.save_mask(labels, np.eye(4), path)
+            np.testing.assert_array_equal(image_io.load_mask(path), labels)
+
+            with self.assertRaises(ValueError):
+                image_io.save_mask(mask, np.eye(4), path, packing='zip')
+
+            fractional = mask * 0.5
+            fractional[2, 3, 0] = np.nan
+            big_labels = labels * 200
+            for name, packing in [('round_trip.nii.gz', 'sparse'),
+                                  ('round_trip.npz', 'sparse'),
+                                  ('round_trip.npz', 'bits')]:
+                round_trip_path = os.path.join(tmp_dir, name)
+                image_io.save_mask(fractional, np.eye(4), round_trip_path,
+                                   packing=packing)
+                loaded = image_io.load_mask(round_trip_path)
+                self.assertEqual(loaded.dtype, np.uint8)
+                np.testing.assert_array_equal(
+                    loaded, np.nan_to_num(fractional) != 0)
+
+                if packing == 'bits':
+                    with self.assertRaises(ValueError):
+                        image_io.save_mask(big_labels, np.eye(4),
+                                           round_trip_path, packing=packing)
+                    continue
+                image_io.save_mask(big_labels, np.eye(4), round_trip_path,
+                                   packing=packing)
+                loaded = image_io.load_mask(round_trip_path)
+                self.assertEqual(loaded.dtype, np.uint16)
+                np.testing.assert_array_equal(loaded, big_labels)
+
+            float_path = os.path.join(tmp_dir, 'float_mask.nii.gz')
+            nib.save(nib.Nifti1Image(labels.astype(np.float32), np.eye(4)),
+                     float_path)
+            np.testing.assert_array_equal(
+                image_io.load_mask(float_path), labels)
+
+            fractional[0, 0, 0] = np.nan
+            nib.save(nib.Nifti1Image(fractional, np.eye(4)), float_path)
+            loaded = image_io.load_mask(float_path)
+            self.assertEqual(loaded.dtype, np.uint8)
+            np.testing.assert_array_equal(
+                loaded, np.nan_to_num(fractional) != 0)
+
+            image_path = os.path.join(tmp_dir, 'image.nii.gz')
+            image_io.save_image(labels * 1.5, np.eye(4), image_path)
+            derived = image_io.load_derived_image(image_path, mask_path=path)
+            np.testing.assert_allclose(
+                derived.get_flat_data(), labels[mask] * 1.5)
+
+    def test_gen_signal_table(self):
+        mock_dwi = test_data.MockDiffusionWeightedImage(
+            data=np.random.uniform(100, 300, size=(10, 10, 3, 12)))
+        dwi = image_io.DiffusionWeightedImage(
+            nib.Nifti1Image(mock_dwi.data, np.eye(4)), mock_dwi.gtab)
+        labels = np.zeros([10, 10, 3], dtype=int)
+        labels[2:6, 3:8, 1] = 2
+        labels[1:3, 1:3, 2] = 5
+        bins = np.zeros((3, 12), dtype=bool)
+        bins[0, :4] = True
+        bins[1, [5, 9]] = True
+
+        table = image_io.gen_signal_table(dwi, labels, bins)
+        self.assertEqual(table.shape, (6, 6))
+        np.testing.assert_array_equal(table[:, 0], [2, 2, 2, 5, 5, 5])
+        np.testing.assert_array_equal(table[:, 1], [0, 1, 2] * 2)
+        np.testing.assert_array_equal(table[:, 2], [20] * 3 + [4] * 3)
+
+        for row in table[:2]:
+            samples = mock_dwi.data[labels == 2][:, bins[int(row[1])]]
+            np.testing.assert_allclose(
+                row[3:], [samples.mean(), np.median(samples), samples.std()])
+
+            # Statistics are over all samples, not over voxel averages
+            voxel_means = samples.mean(axis=1)
+            self.assertGreater(row[5], voxel_means.std())
+            self.assertNotAlmostEqual(row[4], np.median(voxel_means))
+        self.assertTrue(np.isnan(table[2, 3:]).all())
+
@@ -0,0 +1,118 @@
+import datetime
+import os.path
+import tempfile
+import unittest
+
+import nibabel as nib
+import numpy as np
+
+from dmriphantomutils import pipeline, scan_info
+
+def write_scan(scan_dir, n_slices=2):
+    bvals = np.concatenate([np.zeros(4), 1000 * np.ones(15),
+                            2000 * np.ones(15)])
+    bvecs = np.random.normal(size=(34, 3))
+    bvecs /= np.linalg.norm(bvecs, axis=1)[:, np.newaxis]
+    bvecs[:4] = 0
+
+    x, y = np.meshgrid(np.arange(24), np.arange(24), indexing='ij')
+    disk = (x - 12) ** 2 + (y - 11) ** 2 <= 64
+    data = np.random.uniform(5, 10, size=(24, 24, n_slices, 34))
+    data[disk] = (1000 * np.exp(-0.0008 * bvals)
+                  + np.random.uniform(0, 20, size=(disk.sum(), n_slices, 34)))
+
+    paths = [os.path.join(scan_dir, name)
+             for name in ['dwi.nii.gz', 'dwi.bval', 'dwi.bvec']]
+    nib.save(nib.Nifti1Image(data, np.eye(4)), paths[0])
+    np.savetxt(paths[1], bvals[np.newaxis])
+    np.savetxt(paths[2], bvecs.T)
+    return paths
+
+class TestPipeline(unittest.TestCase):
+    def test_run_study(self):
+        tube = [scan_info.WaterSlice(),
+                scan_info.Phantom(225, 30, 0.1, 100,
+                                  scan_info.ConcentricArcPattern((0, 10))),
+                scan_info.Phantom(225, 30, 0.1, 100,
+                                  scan_info.ParallelLinePattern(0))]
+        scan = scan_info.SingleScan(slice(0, 3))
+        study = scan_info.Study('test', tube, [
+            scan_info.ScanSession(datetime.date(2019, 7, 9), [scan])])
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            scan_paths = write_scan(tmp_dir, n_slices=3)
+            output_dir = os.path.join(tmp_dir, 'build')
+
+            tables = pipeline.run_study(
+                study, lambda session, scan: scan_paths, output_dir,
+                workers=1)
+            self.assertEqual(list(tables.keys()), [(0, 0)])
+            self.assertEqual(len(tables[(0, 0)]), 3)
+
+            with open(tables[(0, 0)][0]) as table_file:
+                header = table_file.readline().split()
+            self.assertEqual(header, pipeline.DKI_METRICS)
+
+            with open(tables[(0, 0)][1]) as table_file:
+                header = table_file.readline().split()
+            self.assertEqual(
+                header, ['direction', 'arc_radius', 'crossing_angle']
+                + pipeline.DKI_METRICS)
+            table = np.loadtxt(tables[(0, 0)][1], skiprows=1)
+            self.assertEqual(table.shape[1], 10)
+            self.assertGreater(table.shape[0], 50)
+
+            mtimes = {path: os.path.getmtime(path)
+                      for path in tables[(0, 0)]}
+            pipeline.run_study(
+                study, lambda session, scan: scan_paths, output_dir,
+                workers=1)
+            for path, mtime in mtimes.items():
+                self.assertEqual(os.path.getmtime(path), mtime)
+
+    def test_stage_params(self):
+        pattern = scan_info.ParallelLinePattern(0)
+        phantoms = [scan_info.Phantom(225, 30, 0.1, 100, pattern)]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            scan_paths = write_scan(tmp_dir, n_slices=1)
+            output_dir = os.path.join(tmp_dir, 'build')
+            mask_path = os.path.join(output_dir, 'slice_0_mask.nii.gz')
+            md_path = os.path.join(output_dir, 'slice_0_md.nii.gz')
+            truth_path = os.path.join(
+                output_dir, 'slice_0_truth_direction.nii.gz')
+
+            pipeline.process_scan(*scan_paths, phantoms, output_dir)
+            mtimes = {path: os.path.getmtime(path)
+                      for path in [mask_path, md_path, truth_path]}
+
+            # Refitting with blur must not reuse the unblurred fit
+            pipeline.process_scan(*scan_paths, phantoms, output_dir,
+                                  blur=True)
+            self.assertEqual(os.path.getmtime(mask_path), mtimes[mask_path])
+            self.assertGreater(os.path.getmtime(md_path), mtimes[md_path])
+
+            mtimes = {path: os.path.getmtime(path)
+                      for path in [md_path, truth_path]}
+            pattern.cura_angle = 90
+            pipeline.process_scan(*scan_paths, phantoms, output_dir,
+                                  blur=True)
+            self.assertEqual(os.path.getmtime(md_path), mtimes[md_path])
+            self.assertGreater(
+                os.path.getmtime(truth_path), mtimes[truth_path])
+
+    def test_is_up_to_date(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            input_path = os.path.join(tmp_dir, 'input')
+            stamp_path = os.path.join(tmp_dir, 'stage.stamp')
+            open(input_path, 'w').close()
+
+            self.assertTrue(pipeline.is_up_to_date([], [input_path]))
+            self.assertFalse(pipeline.is_up_to_date(
+                [], [input_path], stamp_path, {'blur': False}))
+
+            pipeline.write_stamp(stamp_path, {'blur': False})
+            self.assertTrue(pipeline.is_up_to_date(
+                [], [input_path], stamp_path, {'blur': False}))
+            self.assertFalse(pipeline.is_up_to_date(
+                [], [input_path], stamp_path, {'blur': True}))
@@ -1,7 +1,22 @@
 import unittest
 
+import numpy as np
+
 from dmriphantomutils import scan_info
 
+POINTS = np.array([(0, 0), (1, 0), (0, 1), (-1, 0), (0, -1), (1, 1),
+                   (1, -1), (-1, 1), (-1, -1), (3, 4)])
+
+def assert_matches_generators(pattern):
+    generators = pattern.get_geometry_generators()
+    array_generators = pattern.get_array_geometry_generators()
+    assert generators.keys() == array_generators.keys()
+
+    for metric, generator in generators.items():
+        np.testing.assert_allclose(
+            array_generators[metric](POINTS),
+            [generator(tuple(point)) for point in POINTS])
+
 class TestConcentricArcPattern(unittest.TestCase):
     def setUp(self):
         self.pattern = scan_info.ConcentricArcPattern((0, 0))
@@ -22,6 +37,10 @@ class TestConcentricArcPattern(unittest.TestCase):
         get_arc_radius = self.pattern.get_geometry_generators()['arc_radius']
         self.assertEqual(get_arc_radius((3, 4)), 5)
 
+    def test_array_generators(self):
+        assert_matches_generators(self.pattern)
+        assert_matches_generators(scan_info.ConcentricArcPattern((-5, 2)))
+
 class TestParallelLinePattern(unittest.TestCase):
     def setUp(self):
         self.pattern = scan_info.ParallelLinePattern(0)
@@ -30,6 +49,9 @@ class TestParallelLinePattern(unittest.TestCase):
         get_direction = self.pattern.get_geometry_generators()['direction']
         self.assertEqual(get_direction((1, 1)), 90)
 
+    def test_array_generators(self):
+        assert_matches_generators(self.pattern)
+
 class TestAlternatingPattern(unittest.TestCase):
     def setUp(self):
         self.pattern = scan_info.AlternatingPattern(
@@ -42,3 +64,12 @@ class TestAlternatingPattern(unittest.TestCase):
         self.assertEqual(get_crossing_angle((0, 0)), 90)
         self.assertEqual(get_crossing_angle((1, 0)), 0)
 
+    def test_array_generators(self):
+        assert_matches_generators(self.pattern)
+        assert_matches_generators(scan_info.AlternatingPattern(
+            scan_info.ConcentricArcPattern((0, 6.5)),
+            scan_info.ParallelLinePattern(90)))
+
+class TestEmptyPattern(unittest.TestCase):
+    def test_array_generators(self):
+        assert_matches_generators(scan_info.EmptyPattern())
@@ -20,6 +20,21 @@ class TestTransformData(unittest.TestCase):
         self.assertAlmostEqual(
                 transform_data.find_centroid(mask_data[..., 1])[1], 30)
 
+    def test_find_centroids(self):
+        x, y = np.meshgrid(np.arange(50), np.arange(50), indexing='ij')
+        labels = np.zeros([50, 50, 3], dtype=np.uint8)
+        labels[..., 0][(x - 10) ** 2 + (y - 12) ** 2 <= 25] = 1
+        labels[..., 2][(x - 30) ** 2 + (y - 35) ** 2 <= 36] = 3
+        labels[10, 12, 0] = 0
+
+        centroids = transform_data.find_centroids(labels)
+        self.assertEqual(sorted(centroids.keys()), [1, 3])
+        np.testing.assert_allclose(centroids[1], (10, 12, 0))
+        np.testing.assert_allclose(centroids[3], (30, 35, 2))
+
+        np.testing.assert_allclose(
+            transform_data.find_centroid(labels[..., 2]), (30, 35))
+
     def test_transform_image_point(self):
         self.assertAlmostEqual(
             transform_data.transform_image_point(
@@ -57,6 +72,38 @@ class TestTransformData(unittest.TestCase):
         with self.assertRaises(TypeError):
             transform_data.transform_image_point((3, 3), (2, 2))
 
+    def test_transform_image_points(self):
+        points = np.array([[3, 3, 0], [3, 0, 1], [0, 7, 2], [2, 2, 0]])
+        centroid = (2, 2)
+
+        for kwargs in [{'angle': 0}, {'angle': 90}, {'fiducial': (2, 1)},
+                       {'fiducial': (5, 6)}]:
+            transformed = transform_data.transform_image_points(
+                points, centroid, **kwargs)
+            self.assertEqual(transformed.shape, (4, 2))
+            np.testing.assert_allclose(
+                transformed,
+                [transform_data.transform_image_point(
+                    point[:2], centroid, **kwargs) for point in points],
+                atol=1e-12)
+
+        np.testing.assert_allclose(
+            transform_data.transform_image_points(
+                points[:, :2], centroid, angle=30),
+            transform_data.transform_image_points(
+                points, centroid, angle=30))
+
+        with self.assertRaises(TypeError):
+            transform_data.transform_image_points(points, centroid)
+
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            transform_data.transform_image_points(
+                points, centroid, angle=30, fiducial=(5, 6))
+            self.assertEqual(
+                str(w[-1].message),
+                'Both angle (30) and fiducial ((5, 6)) were provided to '
+                'transform_image_points. Defaulting to angle.')
 
     def test_compare_to_pattern(self):
         img = test_data.MockDerivedImage()
@@ -80,3 +127,16 @@ class TestTransformData(unittest.TestCase):
 
         self.assertAlmostEqual(pattern_r[15, 15, 2], 0)
 
+
+    def test_gen_geometry_data_vectorized(self):
+        mask = test_data.MockDerivedImage().mask
+        centroid = (15, 15)
+
+        for kwargs in [{'angle': 30}, {'fiducial': (15, 4)}]:
+            looped = transform_data.gen_geometry_data(
+                mask, lambda point: point[0] - 2 * point[1], centroid, 0.5,
+                **kwargs)
+            vectorized = transform_data.gen_geometry_data(
+                mask, lambda points: points[:, 0] - 2 * points[:, 1],
+                centroid, 0.5, vectorized=True, **kwargs)
+            np.testing.assert_allclose(vectorized, looped, atol=1e-12)